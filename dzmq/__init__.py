@@ -1 +1,2 @@
-from .core import DZMQ
\ No newline at end of file
+from .core import DZMQ, ServiceError
+from .msgtypes import MessageType
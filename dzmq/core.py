@@ -6,12 +6,22 @@ import logging
 import platform
 import struct
 import atexit
-from collections import defaultdict
+from collections import defaultdict, deque
 import sys
 import time
 import netifaces
+import zlib
 import base64
+import copy
 import json
+import threading
+import heapq
+import math
+import mmap
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 try:
     from bson import Binary, BSON
 except ImportError:
@@ -23,6 +33,8 @@ except ImportError:
     np = None
 
 from .utils import get_log
+from .topics import TopicTrie, topic_matches
+from .msgtypes import TYPE_HASH_LENGTH
 
 
 # Defaults and overrides
@@ -37,18 +49,82 @@ DZMQ_IFACE_KEY = 'DZMQ_IFACE'
 OP_ADV = 0x01
 OP_SUB = 0x02
 OP_SYN = 0x03
+OP_SRV = 0x04
+OP_UNADV = 0x05
+
+FLAG_PREFIX = 0x01
+# A SUB may ask for at most so many messages per second, as a float at
+# FLAGS[4:8].  Publishers send those on a separate topic: RATE_PREFIX, the
+# rate, RATE_SEPARATOR, then the topic name.
+RATE_OFFSET = 4
+RATE_STRUCT = struct.Struct('<f')
+RATE_PREFIX = '@'
+RATE_SEPARATOR = ':'
 
 PUB_HB = b'H'
 PUB_MSG = b'M'
+PUB_STRUCT = b'S'
+PUB_CHUNK = b'C'
+PUB_DELTA = b'D'
+
+# Control channel messages
+CTL_HB = b'H'
+CTL_SYN = b'S'
+CTL_UNSUB = b'U'
+
+SRV_OK = b'0'
+SRV_ERR = b'1'
 
-UDP_MAX_SIZE = 512
+# Enough for an ADV with a topic of TOPIC_MAXLENGTH and two addresses of
+# ADDRESS_MAXLENGTH, with room to spare for auxiliary socket suffixes
+UDP_MAX_SIZE = 1024
 GUID_LENGTH = 16
 ADV_REPEAT_PERIOD = 1.11
 HB_REPEAT_PERIOD = 1.0
+SRV_EXPIRE_PERIOD = 3 * ADV_REPEAT_PERIOD
+SRV_CALL_TIMEOUT = 10.0
+PEER_TIMEOUT = 3 * ADV_REPEAT_PERIOD
 VERSION = 0x0001
 TOPIC_MAXLENGTH = 192
 FLAGS_LENGTH = 16
+TYPE_HASH_OFFSET = FLAGS_LENGTH - TYPE_HASH_LENGTH
+# Optional trace extension of the PUB header: GUID, sequence number, and
+# send time
+TRACE_STRUCT = struct.Struct('<%dsQd' % GUID_LENGTH)
+LATENCY_BUCKETS = 32
+# Adaptive rate limiting: halve the rate on a drop, and win back this
+# fraction of the configured rate on every successful send
+ADAPTIVE_INCREASE = 0.01
+ADAPTIVE_MIN_RATE = 1.0
+# Header of a stream chunk: GUID, stream ID, chunk index, and whether it is
+# the last chunk
+CHUNK_STRUCT = struct.Struct('<%dsQQ?' % GUID_LENGTH)
+STREAM_CHUNK_SIZE = 1 << 20
+# Chunks a stream may have queued in zmq before we wait for them to go out,
+# and chunks sent per pass of the event loop
+STREAM_MAX_INFLIGHT = 8
+STREAM_CHUNKS_PER_SPIN = 16
+STREAM_RETRY_PERIOD = 0.001
+STREAM_MAX_SIZE = 1 << 28
+STREAM_TIMEOUT = 10.0
+# Header of a delta encoded array: GUID, sequence number, kind, number of
+# changed elements for a sparse delta, and number of dimensions.  The shape
+# (8 bytes per dimension) and dtype string follow.
+DELTA_STRUCT = struct.Struct('<%dsQBQB' % GUID_LENGTH)
+DELTA_KEY = 0
+DELTA_SPARSE = 1
+DELTA_XOR = 2
+DELTA_KEYFRAME_INTERVAL = 100
+# Send a sparse delta if it is smaller than this fraction of the array, or
+# else a compressed XOR if that is, or else a keyframe
+DELTA_SPARSE_RATIO = 0.25
+DELTA_XOR_RATIO = 0.5
+# Messages published from other threads that may wait for the event loop
+THREAD_QUEUE_MAXSIZE = 10000
 ADDRESS_MAXLENGTH = 267
+# Time in milliseconds to let a parting message go out before closing a
+# control connection
+CTL_LINGER = 100
 DEBUG = False
 
 
@@ -58,7 +134,7 @@ def unpack_msg(data):
 
     Parameters
     ----------
-    data : bytes
+    data : bytes, memoryview or zmq.Frame
         Binary data message.
 
     Returns
@@ -66,16 +142,20 @@ def unpack_msg(data):
     out : dict
         Unpacked message.
     """
+    if isinstance(data, zmq.Frame):
+        data = data.buffer
+    if not isinstance(data, bytes):
+        # The decoders need a bytes object
+        data = bytes(data)
+
     def unpack(obj):
-        if not BSON:
-            obj = json.loads(obj.decode('utf-8'))
         for (key, value) in obj.items():
             if isinstance(value, dict):
                 if ('shape' in value and 'dtype' in value and 'data' in value
                         and np):
                     if BSON is None:
                         value['data'] = base64.b64decode(value['data'])
-                        obj[key] = np.fromstring(value['data'],
+                        obj[key] = np.frombuffer(value['data'],
                                                  dtype=value['dtype'])
                     else:
                         obj[key] = np.frombuffer(value['data'],
@@ -87,11 +167,55 @@ def unpack_msg(data):
         return obj
 
     if BSON is None:
-        return unpack(data)
+        return unpack(json.loads(data.decode('utf-8')))
     else:
         return unpack(BSON(data).decode())
 
 
+def _rate_tag(rate):
+    """
+    Get the string that identifies a decimated rate on the wire.  The rate
+    is rounded to the precision of the SUB flags first, so that publishers
+    and subscribers agree on it.
+    """
+    return '%g' % RATE_STRUCT.unpack(RATE_STRUCT.pack(rate))[0]
+
+
+def _rate_topic(topic, tag):
+    """
+    Get the name of the topic a decimated rate is sent on.
+    """
+    if tag is None:
+        return topic
+    return '%s%s%s%s' % (RATE_PREFIX, tag, RATE_SEPARATOR, topic)
+
+
+def _as_words(arr):
+    """
+    View the elements of a contiguous array as flat unsigned integers of the
+    same size (or as bytes), so that they can be compared and XOR'd exactly.
+    """
+    flat = arr.reshape(-1)
+    if arr.dtype.itemsize in (1, 2, 4, 8):
+        return flat.view('u%d' % arr.dtype.itemsize)
+    return flat.view(np.uint8)
+
+
+def _read_only(obj):
+    """
+    Get a view of a message that cannot be modified in place, as far as we
+    can manage it without copying: NumPy arrays, including those in dicts,
+    are made read-only.
+    """
+    if np is not None and isinstance(obj, np.ndarray):
+        view = obj.view()
+        view.flags.writeable = False
+        return view
+    if isinstance(obj, dict):
+        return dict((key, _read_only(value)) for (key, value) in obj.items())
+    return obj
+
+
 def pack_msg(obj):
     """
     Pack an object into a binary data message.
@@ -108,22 +232,61 @@ def pack_msg(obj):
     """
     if not isinstance(obj, dict):
         obj = dict(___payload__=obj)
+    obj = _encode_arrays(obj)
+    if BSON is None:
+        return json.dumps(obj).encode('utf-8')
+    else:
+        return BSON.encode(obj)
+
+
+def _encode_arrays(obj):
+    """
+    Get a copy of a dictionary with its NumPy arrays, including those in
+    sub-dicts, replaced by their encoded form.  The original is left alone,
+    since it may still be handed to our own subscribers.
+    """
+    out = {}
     for (key, value) in obj.items():
         if np and isinstance(value, np.ndarray):
             if BSON is None:
                 data = base64.b64encode(value.tobytes()).decode('utf-8')
             else:
                 data = Binary(value.tobytes())
-            obj[key] = dict(shape=value.shape,
+            out[key] = dict(shape=value.shape,
                             dtype=value.dtype.str,
                             data=data)
         elif isinstance(value, dict):  # Make sure we recurse into sub-dicts
-            obj[key] = pack_msg(value)
-    print(obj)
-    if BSON is None:
-        return json.dumps(obj).encode('utf-8')
-    else:
-        return BSON.encode(obj)
+            out[key] = _encode_arrays(value)
+        else:
+            out[key] = value
+    return out
+
+
+def unwrap_msg(msg):
+    """
+    Undo the payload wrapping applied by pack_msg to non-dict objects.
+
+    Parameters
+    ----------
+    msg : dict
+        Unpacked message.
+
+    Returns
+    -------
+    out : object
+        The original object passed to pack_msg.
+    """
+    if len(msg) == 1 and '___payload__' in msg:
+        return msg['___payload__']
+    return msg
+
+
+class ServiceError(Exception):
+
+    """
+    Raised when a service call fails or times out.
+    """
+    pass
 
 
 class DZMQ(object):
@@ -150,7 +313,8 @@ class DZMQ(object):
 
     """
 
-    def __init__(self, context=None, log=None, address=None):
+    def __init__(self, context=None, log=None, address=None, io_threads=1,
+                 pub_shards=1, socket_options=None):
         """ Initialize the DZMQ interface
 
         Parameters
@@ -161,8 +325,21 @@ class DZMQ(object):
             Logger instance.
         address : str
             Valid ZMQ address: tcp:// or ipc://.
+        io_threads : int, optional
+            Number of zmq I/O threads, if we create our own context.
+        pub_shards : int, optional
+            Number of PUB sockets that topics are hashed across.  Each shard
+            is bound to its own address.
+        socket_options : dict, optional
+            Mapping of zmq socket options to values, applied to all PUB
+            sockets.
         """
+        self._own_context = context is None and io_threads != 1
+        if self._own_context:
+            context = zmq.Context(io_threads)
         self.context = context or zmq.Context.instance()
+        self.pub_shards = pub_shards
+        self.socket_options = socket_options or {}
         self.log = log or get_log()
         self.guid = uuid.uuid4()
 
@@ -239,13 +416,23 @@ class DZMQ(object):
         # Bookkeeping (which should be cleaned up)
         self.publishers = []
         self.subscribers = []
+        self._topic_trie = TopicTrie()
         self.sub_connections = []
         self.poller = zmq.Poller()
         self._listeners = defaultdict(dict)
-
-        # Set up the one pub and one sub socket that we'll use
+        self._link_stats = {}
+        self._stream_count = 0
+        # Last array received from each delta encoded publisher
+        self._delta_state = {}
+        # Messages for our own subscribers, waiting for the event loop
+        self._local_queue = deque()
+
+        # Set up the default pub socket and the one sub socket that we'll
+        # use.  Other pub sockets (shards) are created as needed.
         self.pub_socket = self.context.socket(zmq.PUB)
         self.pub_socket_addrs = []
+        for (option, value) in self.socket_options.items():
+            self.pub_socket.setsockopt(option, value)
         if not self.address:
             tcp_addr = 'tcp://%s' % (self.ipaddr)
             tcp_port = self.pub_socket.bind_to_random_port(tcp_addr)
@@ -259,6 +446,9 @@ class DZMQ(object):
                             % (len(self.address), ADDRESS_MAXLENGTH))
         self.pub_socket_addrs.append(self.address)
         self.pub_socket.setsockopt(zmq.LINGER, 0)
+        self._shards = {}
+        self._shards[0] = {'socket': self.pub_socket, 'address': self.address,
+                           'nodrop': False}
         self.sub_socket = self.context.socket(zmq.SUB)
         self.sub_socket.setsockopt(zmq.LINGER, 0)
         self.sub_socket_addrs = []
@@ -266,8 +456,60 @@ class DZMQ(object):
         self.poller.register(self.bcast_recv, zmq.POLLIN)
         self.poller.register(self.sub_socket, zmq.POLLIN)
 
-        self._last_hb_time = 0
-        self._last_adv_time = 0
+        # Messages published from threads other than the event loop's are
+        # packed by the publishing thread and queued for the loop.  The loop
+        # is woken through a PUSH socket shared by all threads under a lock,
+        # which is only rung when no wake up call is pending already.
+        self._loop_thread = threading.current_thread()
+        self._thread_queue = deque()
+        self._thread_lock = threading.Lock()
+        self._wakeup_pending = False
+        self._collector_addr = 'inproc://dzmq-pub-%s' % self.guid
+        self._collector = self.context.socket(zmq.PULL)
+        self._collector.setsockopt(zmq.LINGER, 0)
+        self._collector.bind(self._collector_addr)
+        self.poller.register(self._collector, zmq.POLLIN)
+        self._doorbell = self.context.socket(zmq.PUSH)
+        self._doorbell.setsockopt(zmq.LINGER, 0)
+        self._doorbell.connect(self._collector_addr)
+
+        # Service bookkeeping.  Providers are keyed by service name and then
+        # by address, with the time we last heard an advertisement.
+        self.services = {}
+        self.srv_socket = None
+        self.srv_address = None
+        self._srv_reply_socket = None
+        self._srv_reply_addr = 'inproc://dzmq-srv-%s' % self.guid
+        self._srv_providers = defaultdict(dict)
+        self._srv_requests = {}
+        self._srv_waiting = set()
+        self._srv_inflight = defaultdict(int)
+        self._srv_count = 0
+        self._peer_sockets = {}
+
+        # Control channel bookkeeping.  Our control ROUTER socket is created
+        # when we first advertise, and we keep one DEALER connection to the
+        # control socket of each publisher we subscribe to.
+        self.ctl_socket = None
+        self.ctl_address = None
+        self._ctl_sockets = {}
+        self._ctl_clients = defaultdict(dict)
+
+        # Publishers we've heard from, keyed by GUID, and how they come and
+        # go
+        self._peers = {}
+        self._peer_stats = {'joined': 0, 'expired': 0, 'restarted': 0}
+
+        # Timers are kept in a heap of (deadline, count, timer)
+        self._timers = []
+        self._timer_count = 0
+        now = time.time()
+        self._add_timer(now, HB_REPEAT_PERIOD, self._send_heartbeats)
+        self._add_timer(now, ADV_REPEAT_PERIOD, self._send_adverts)
+        self._add_timer(now + PEER_TIMEOUT, HB_REPEAT_PERIOD,
+                        self._expire_peers)
+        self._add_timer(now + SRV_EXPIRE_PERIOD, HB_REPEAT_PERIOD,
+                        self._expire_srv_providers)
 
     def _start_bcast_recv(self):
         if self.bcast_host == MULTICAST_GRP:
@@ -284,31 +526,81 @@ class DZMQ(object):
             self.log.info("Opened (%s, %s)" %
                           (self.bcast_host, self.bcast_port))
 
-    def _advertise(self, publisher):
+    def _pack_header(self, topic, op, flags=None):
         """
-        Internal method to pack and broadcast ADV message.
+        Internal method to pack the header shared by all broadcast messages.
         """
         msg = b''
         msg += struct.pack('<H', VERSION)
         msg += self.guid.bytes
-        msg += struct.pack('<B', len(publisher['topic']))
-        msg += publisher['topic'].encode('utf-8')
-        msg += struct.pack('<B', OP_ADV)
-        # Flags unused for now
+        msg += struct.pack('<B', len(topic))
+        msg += topic.encode('utf-8')
+        msg += struct.pack('<B', op)
+        if flags is None:
+            flags = [0x00] * FLAGS_LENGTH
+        msg += struct.pack('<%dB' % FLAGS_LENGTH, *flags)
+        return msg
+
+    def _pack_adverts(self, publisher):
+        """
+        Internal method to pack the ADV messages for a publisher, one for
+        each of its addresses.
+        """
         flags = [0x00] * FLAGS_LENGTH
-        msg += struct.pack('<%dB' % (FLAGS_LENGTH), *flags)
-        # We'll announce once for each address
+        if publisher['msg_type'] is not None:
+            flags[TYPE_HASH_OFFSET:] = bytearray(
+                publisher['msg_type'].type_hash)
+        msg = self._pack_header(publisher['topic'], OP_ADV, flags)
+        msgs = []
         for addr in publisher['addresses']:
-            if addr.startswith('inproc'):
-                # Don't broadcast inproc addresses
-                continue
             # Struct objects copy by value
             mymsg = msg
             mymsg += struct.pack('<H', len(addr))
             mymsg += addr.encode('utf-8')
-            self.bcast_send.sendto(mymsg, (self.bcast_host, self.bcast_port))
+            mymsg += struct.pack('<H', len(self.ctl_address))
+            mymsg += self.ctl_address.encode('utf-8')
+            msgs.append(mymsg)
+        return msgs
+
+    def _advertise(self, publisher):
+        """
+        Internal method to pack and broadcast ADV message.
+        """
+        # We'll announce once for each address
+        for msg in self._pack_adverts(publisher):
+            self.bcast_send.sendto(msg, (self.bcast_host, self.bcast_port))
 
-    def advertise(self, topic):
+    def _get_shard(self, topic, shard=None, socket_options=None,
+                   nodrop=False):
+        """
+        Internal method to get the PUB socket shard for a topic, creating
+        it if need be.  NODROP shards are kept apart from the others.
+        """
+        if shard is None:
+            key = zlib.crc32(topic.encode('utf-8')) % self.pub_shards
+        else:
+            key = str(shard)
+        if nodrop:
+            key = 'nodrop%s' % key
+        if key not in self._shards:
+            sock = self.context.socket(zmq.PUB)
+            sock.setsockopt(zmq.LINGER, 0)
+            if nodrop:
+                sock.setsockopt(zmq.XPUB_NODROP, 1)
+            options = dict(self.socket_options)
+            options.update(socket_options or {})
+            for (option, value) in options.items():
+                sock.setsockopt(option, value)
+            address = self._bind(sock, 'pub%s' % key)
+            self.pub_socket_addrs.append(address)
+            self._shards[key] = {'socket': sock, 'address': address,
+                                 'nodrop': nodrop}
+        return self._shards[key]
+
+    def advertise(self, topic, shard=None, socket_options=None,
+                  msg_type=None, trace=False, rate=None, burst=None,
+                  adaptive=False, nodrop=False, delta=False,
+                  keyframe_interval=DELTA_KEYFRAME_INTERVAL):
         """
         Advertise the given topic.  Do this before calling publish().
 
@@ -316,120 +608,431 @@ class DZMQ(object):
         ----------
         topic : str
             Topic name.
+        shard : str, optional
+            Name of a dedicated PUB socket to publish this topic on, so that
+            high bandwidth topics do not hold up others.  By default, the
+            topic is hashed across the shared PUB sockets.
+        socket_options : dict, optional
+            Mapping of zmq socket options to values for a new dedicated PUB
+            socket.
+        msg_type : MessageType, optional
+            Fixed layout type of the messages, which are then packed with
+            msg_type.pack() instead of pack_msg().
+        trace : bool, optional
+            Whether to send a sequence number and timestamp with each
+            message, so that subscribers can account for loss and latency
+            (see get_link_stats()).
+        rate : float, optional
+            Maximum number of messages per second.  Messages published in
+            excess of this are dropped.
+        burst : float, optional
+            Number of messages that may be sent at once in excess of the
+            rate.  Defaults to one second's worth.
+        adaptive : bool, optional
+            Whether to back off from the rate when the send queue fills up,
+            and recover gradually afterwards.  Implies nodrop.
+        nodrop : bool, optional
+            Whether publish() should report a message as dropped when the send
+            queue to any subscriber is full.  The topic is then sent on a PUB
+            socket with XPUB_NODROP set, where a subscriber that stops
+            reading holds up all of the others, including new subscribers
+            waiting for a heartbeat.  By default, only the slow subscriber
+            misses messages, and publish() does not know about it.
+        delta : bool, optional
+            Whether to send NumPy arrays as the difference from the previous
+            one, for arrays that change little from message to message.
+            Other messages are sent as usual.
+        keyframe_interval : int, optional
+            Number of messages between the full arrays sent with delta
+            encoding, at which subscribers that missed a message recover.
         """
+        if adaptive and rate is None:
+            raise ValueError('Adaptive rate limiting requires a rate')
+        if delta and (np is None or msg_type is not None or trace):
+            raise ValueError('Delta encoding requires NumPy, and does not '
+                             'support msg_type or trace')
         if len(topic) > TOPIC_MAXLENGTH:
             raise Exception('Topic length %d exceeds maximum %d'
                             % (len(topic), TOPIC_MAXLENGTH))
+        if topic.startswith(RATE_PREFIX):
+            raise ValueError('Topic may not start with %r, which is reserved '
+                             'for decimated rates' % RATE_PREFIX)
+        if self.ctl_socket is None:
+            self.ctl_socket = self.context.socket(zmq.ROUTER)
+            self.ctl_socket.setsockopt(zmq.LINGER, 0)
+            self.ctl_address = self._bind(self.ctl_socket, 'ctl')
+            self.poller.register(self.ctl_socket, zmq.POLLIN)
         publisher = {}
-        publisher['socket'] = self.pub_socket
-        inproc_addr = 'inproc://%s' % topic
-
-        if inproc_addr not in self.pub_socket_addrs:
-            publisher['socket'].bind(inproc_addr)
-            self.pub_socket_addrs.append(inproc_addr)
-        address = [a for a in self.pub_socket_addrs
-                   if a.startswith(('tcp', 'ipc'))][0]
-        publisher['addresses'] = [inproc_addr, address]
+        shard = self._get_shard(topic, shard, socket_options,
+                                nodrop or adaptive)
+        publisher['socket'] = shard['socket']
+        publisher['addresses'] = [shard['address']]
         publisher['topic'] = topic
+        publisher['msg_type'] = msg_type
+        if msg_type is not None:
+            publisher['header'] = PUB_STRUCT + msg_type.type_hash
+        else:
+            publisher['header'] = PUB_MSG
+        publisher['trace'] = trace
+        publisher['seq'] = 0
+        publisher['sent'] = 0
+        publisher['dropped'] = 0
+        publisher['rate'] = rate
+        publisher['max_rate'] = rate
+        publisher['adaptive'] = adaptive
+        # Decimated rates requested by subscribers
+        publisher['rates'] = {}
+        publisher['delta'] = None
+        if delta:
+            state = {}
+            state['interval'] = keyframe_interval
+            state['count'] = 0
+            state['seq'] = 0
+            state['words'] = None
+            state['dtype'] = None
+            state['shape'] = None
+            state['key'] = False
+            publisher['delta'] = state
+        if rate is not None:
+            publisher['burst'] = burst or max(rate, 1.0)
+            publisher['tokens'] = publisher['burst']
+            publisher['tstamp'] = time.time()
+        # Make sure that the ADV fits in what our peers will read
+        length = max(len(msg) for msg in self._pack_adverts(publisher))
+        if length > UDP_MAX_SIZE:
+            raise Exception('Advertisement length %d exceeds maximum %d'
+                            % (length, UDP_MAX_SIZE))
         self.publishers.append(publisher)
         self._advertise(publisher)
 
-        # Also connect to internal subscribers, if there are any
-        adv = {}
-        adv['topic'] = topic
-        adv['address'] = inproc_addr
-        adv['guid'] = self.guid
-        for sub in self.subscribers:
-            if sub['topic'] == topic:
-                self._connect_subscriber(adv)
-
     def unadvertise(self, topic):
         """
         Unadvertise a topic.
 
+        Our subscribers are told straight away, so that they can disconnect.
+
         Parameters
         ----------
         topic : str
             Topic name.
         """
+        publishers = [p for p in self.publishers if p['topic'] == topic]
+        if not publishers:
+            return
         self.publishers = [p for p in self.publishers if p['topic'] != topic]
+        topics = [topic] + [r['topic'] for p in publishers
+                            for r in p['rates'].values()]
+        for name in topics:
+            self._listeners.pop(name, None)
+            for client in self._ctl_clients.values():
+                client.pop(name, None)
+        msg = self._pack_header(topic, OP_UNADV)
+        self.bcast_send.sendto(msg, (self.bcast_host, self.bcast_port))
 
     def _subscribe(self, subscriber):
         """
         Internal method to pack and broadcast SUB message.
         """
-        msg = b''
-        msg += struct.pack('<H', VERSION)
-        msg += self.guid.bytes
-        msg += struct.pack('<B', len(subscriber['topic']))
-        msg += subscriber['topic'].encode('utf-8')
-        msg += struct.pack('<B', OP_SUB)
-        # Flags unused for now
         flags = [0x00] * FLAGS_LENGTH
-        msg += struct.pack('<%dB' % FLAGS_LENGTH, *flags)
+        if subscriber.get('prefix'):
+            flags[0] |= FLAG_PREFIX
+        if subscriber.get('rate') is not None:
+            flags[RATE_OFFSET:RATE_OFFSET + RATE_STRUCT.size] = bytearray(
+                RATE_STRUCT.pack(float(subscriber['rate'])))
+        msg = self._pack_header(subscriber['topic'], OP_SUB, flags)
         # Null body
         self.bcast_send.sendto(msg, (self.bcast_host, self.bcast_port))
 
-    def _synch(self, topic, address):
+    def _synch(self, topic, ctl_address):
         """
-        Internal method to pack and broadcast SYN message.
+        Internal method to send a SYN to a publisher over its control
+        channel.
         """
-        msg = b''
-        msg += struct.pack('<H', VERSION)
-        msg += self.guid.bytes
-        msg += struct.pack('<B', len(topic))
-        msg += topic.encode('utf-8')
-        msg += struct.pack('<B', OP_SYN)
-        # Flags unused for now
-        flags = [0x00] * FLAGS_LENGTH
-        msg += struct.pack('<%dB' % FLAGS_LENGTH, *flags)
-        msg += struct.pack('<H', len(address))
-        msg += address.encode('utf-8')
-        msg += struct.pack('<H', len(self.address))
-        msg += self.address.encode('utf-8')
-        self.bcast_send.sendto(msg, (self.bcast_host, self.bcast_port))
+        sock = self._get_peer_socket(ctl_address, self._ctl_sockets)
+        try:
+            sock.send_multipart((CTL_SYN, topic.encode('utf-8'),
+                                 self.address.encode('utf-8')), zmq.NOBLOCK)
+        except zmq.Again:
+            pass
 
-    def subscribe(self, topic, cb):
+    def _handle_ctl_recv(self):
+        """
+        Internal method to handle all pending SYNs from our subscribers.
+        """
+        while True:
+            try:
+                ident, op, topic, sub_addr = self.ctl_socket.recv_multipart(
+                    zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            topic = topic.decode('utf-8')
+            sub_addr = sub_addr.decode('utf-8')
+            if op == CTL_UNSUB:
+                self._listeners[topic].pop(sub_addr, None)
+                self._ctl_clients[ident].pop(topic, None)
+                continue
+            if op != CTL_SYN or sub_addr == self.address:
+                continue
+            if sub_addr not in self._listeners.get(topic, ()):
+                # Don't keep a new subscriber waiting for a keyframe
+                for p in self.publishers:
+                    if p['topic'] == topic and p['delta'] is not None:
+                        p['delta']['key'] = True
+            now = time.time()
+            self._listeners[topic][sub_addr] = now
+            self._ctl_clients[ident][topic] = now
+
+    def _handle_ctl_reply(self, ctl_address, sock):
+        """
+        Internal method to answer all pending heartbeats from a publisher.
+        """
+        while True:
+            try:
+                op, topic = sock.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            topic = topic.decode('utf-8')
+            self._touch_connections('ctl_address', ctl_address)
+            if op == CTL_HB and [c for c in self.sub_connections
+                                 if c['wire_topic'] == topic and
+                                 c['synched'] and
+                                 c['ctl_address'] == ctl_address]:
+                self._synch(topic, ctl_address)
+
+    def _heartbeat(self):
+        """
+        Internal method to send heartbeats to the subscribers we know of,
+        and forget about those that have gone quiet.
+        """
+        now = time.time()
+        topics = set(p['topic'] for p in self.publishers)
+        topics.update(r['topic'] for p in self.publishers
+                      for r in p['rates'].values())
+        for (ident, client) in list(self._ctl_clients.items()):
+            for (topic, tstamp) in list(client.items()):
+                if (now - tstamp) > 2 * HB_REPEAT_PERIOD:
+                    del client[topic]
+                elif topic in topics:
+                    try:
+                        self.ctl_socket.send_multipart(
+                            (ident, CTL_HB, topic.encode('utf-8')),
+                            zmq.NOBLOCK)
+                    except zmq.Again:
+                        pass
+            if not client:
+                del self._ctl_clients[ident]
+        # Listeners are kept a while longer, since they decide whether we
+        # serialize messages at all
+        for (topic, listeners) in list(self._listeners.items()):
+            for (sub_addr, tstamp) in list(listeners.items()):
+                if (now - tstamp) > PEER_TIMEOUT:
+                    del listeners[sub_addr]
+            if not listeners:
+                del self._listeners[topic]
+        # Stop serving the decimated rates that nobody has listened to for a
+        # while, giving new subscribers time to synchronize
+        for p in self.publishers:
+            for (tag, rate) in list(p['rates'].items()):
+                if (not self._listeners.get(rate['topic']) and
+                        (now - rate['tstamp']) > PEER_TIMEOUT):
+                    del p['rates'][tag]
+
+    def subscribe(self, topic, cb, prefix=False, raw=False, msg_type=None,
+                  copy=False, queued=True, max_rate=None):
         """
         Subscribe to the given topic.  Received messages will be passed to
         given the callback, which should have the signature: cb(msg).
 
+        The topic may contain `*` wildcards, each of which matches any run of
+        characters other than `/`, e.g. 'sensors/*'.
+
         topic : str
-            Name of topic.
+            Name of topic, or topic pattern.
         cb : callable
             Callable that accepts one argument (msg).
+        prefix : bool, optional
+            Whether to match all topics starting with the given topic.
+        raw : bool, optional
+            Whether to skip unpacking and pass the callback the list of
+            zmq.Frame objects making up the message instead.  The frames can
+            be handed to forward() as they are.
+        msg_type : MessageType, optional
+            Fixed layout type of the messages.  Publishers advertising a
+            different type, or any type at all if this is not given and the
+            subscriber is not raw, will be ignored.
+        copy : bool, optional
+            Whether messages published by this DZMQ instance are passed to
+            the callback as a deep copy.  By default they are passed as they
+            are, with NumPy arrays made read-only, and must not be modified.
+        queued : bool, optional
+            Whether messages published by this DZMQ instance are delivered
+            from the event loop.  Otherwise, the callback is called from
+            publish() itself.
+        max_rate : float, optional
+            Maximum number of messages per second to receive, which must be
+            positive.  Publishers drop the rest before sending them.
         """
+        if max_rate is not None and not max_rate > 0:
+            raise ValueError('Maximum rate must be positive, not %r'
+                             % max_rate)
         # Record what we're doing
+        subscriber = self._make_subscriber(topic, cb, prefix, raw=raw,
+                                           msg_type=msg_type, copy=copy,
+                                           queued=queued)
+        if max_rate is not None:
+            subscriber['rate'] = _rate_tag(max_rate)
+            subscriber['period'] = 1.0 / float(subscriber['rate'])
+        self._add_subscriber(subscriber)
+
+    def subscribe_batch(self, topic, cb, max_batch=100, max_latency=0.01,
+                        prefix=False, msg_type=None):
+        """
+        Subscribe to the given topic, receiving messages in batches.  The
+        callback should have the signature: cb(msgs).
+
+        If every message in a batch is a NumPy array of the same shape and
+        dtype, msgs is a single array stacked along a new first axis.  This
+        array is reused between batches, so copy it to keep it.  Otherwise
+        msgs is a list.
+
+        topic : str
+            Name of topic, or topic pattern.
+        cb : callable
+            Callable that accepts one argument (msgs).
+        max_batch : int, optional
+            Maximum number of messages in a batch.
+        max_latency : float, optional
+            Maximum time in seconds to hold on to a message before delivering
+            an incomplete batch.
+        prefix : bool, optional
+            Whether to match all topics starting with the given topic.
+        msg_type : MessageType, optional
+            Fixed layout type of the messages.
+        """
+        batch = {}
+        batch['max_batch'] = max_batch
+        batch['max_latency'] = max_latency
+        batch['msgs'] = []
+        batch['array'] = None
+        batch['stacked'] = False
+        batch['count'] = 0
+        batch['timer'] = None
+        self._add_subscriber(self._make_subscriber(
+            topic, cb, prefix, msg_type=msg_type, batch=batch))
+
+    def subscribe_stream(self, topic, cb=None, chunk_cb=None,
+                         max_size=STREAM_MAX_SIZE, timeout=STREAM_TIMEOUT,
+                         prefix=False):
+        """
+        Subscribe to streams sent with publish_stream() on the given topic.
+
+        Complete streams are passed to cb(data), with the payload as a
+        bytearray.  Each chunk is also passed to chunk_cb(stream_id, index,
+        data, last) as it arrives, with the chunk as a buffer.  Without cb,
+        streams are not reassembled, so memory use does not grow with their
+        size.
+
+        topic : str
+            Name of topic, or topic pattern.
+        cb : callable, optional
+            Callable that accepts one argument (data).
+        chunk_cb : callable, optional
+            Callable that accepts four arguments (stream_id, index, data,
+            last).
+        max_size : int, optional
+            Maximum size in bytes of a reassembled stream.  Larger streams
+            are dropped.
+        timeout : float, optional
+            Time in seconds to wait for the next chunk of a stream before
+            dropping it.
+        prefix : bool, optional
+            Whether to match all topics starting with the given topic.
+        """
+        stream = {}
+        stream['chunk_cb'] = chunk_cb
+        stream['max_size'] = max_size
+        stream['timeout'] = timeout
+        stream['partial'] = {}
+        self._add_subscriber(self._make_subscriber(topic, cb, prefix,
+                                                   stream=stream))
+
+    def _make_subscriber(self, topic, cb, prefix=False, **overrides):
+        """
+        Internal method to make a subscriber record, with the settings of a
+        plain subscribe() for everything not overridden.
+        """
         subscriber = {}
         subscriber['topic'] = topic
         subscriber['cb'] = cb
+        subscriber['prefix'] = prefix
+        subscriber['raw'] = False
+        subscriber['msg_type'] = None
+        subscriber['copy'] = False
+        subscriber['queued'] = True
+        # Decimated rate, with the period and time of the next message due
+        subscriber['rate'] = None
+        subscriber['period'] = None
+        subscriber['next'] = 0.0
+        subscriber['batch'] = None
+        subscriber['stream'] = None
+        for (key, value) in overrides.items():
+            if key not in subscriber:
+                raise ValueError('Unknown subscriber setting %s' % key)
+            subscriber[key] = value
+        return subscriber
+
+    def _add_subscriber(self, subscriber):
+        """
+        Internal method to record a subscriber and find its publishers.
+        """
+        topic = subscriber['topic']
+        prefix = subscriber['prefix']
+        if len(topic) > TOPIC_MAXLENGTH:
+            raise Exception('Topic length %d exceeds maximum %d'
+                            % (len(topic), TOPIC_MAXLENGTH))
+        if topic.startswith(RATE_PREFIX):
+            raise ValueError('Topic may not start with %r, which is reserved '
+                             'for decimated rates' % RATE_PREFIX)
         self.subscribers.append(subscriber)
+        self._topic_trie.insert(topic, subscriber, prefix)
         self._subscribe(subscriber)
 
-        # Also connect to internal publishers, if there are any
-        adv = {}
-        adv['topic'] = subscriber['topic']
-        adv['address'] = 'inproc://%s' % subscriber['topic']
-        adv['guid'] = self.guid
-        for pub in self.publishers:
-            if pub['topic'] == subscriber['topic']:
-                self._connect_subscriber(adv)
-
     def unsubscribe(self, topic):
         """
-        Unsubscribe from a given topic.
+        Unsubscribe from a given topic.  Batched subscribers get their
+        pending batch first.
 
         Parameters
         ----------
         topic : str
             Name of topic.
         """
+        for sub in self.subscribers:
+            if sub['topic'] == topic:
+                self._topic_trie.remove(sub)
+                if sub['batch'] is not None:
+                    self._flush_batch(sub)
+                if sub['stream'] is not None:
+                    for partial in sub['stream']['partial'].values():
+                        self.cancel_timer(partial['timer'])
         self.subscribers = [s for s in self.subscribers if s['topic'] != topic]
 
+        # Stop the traffic that nobody wants any more
+        [self._drop_connection(c) for c in list(self.sub_connections)
+         if not [s for s in self._topic_trie.match(c['topic'])
+                 if s['rate'] == c['rate']]]
+
     def publish(self, topic, msg):
         """
         Publish the given message on the given topic.  You should have called
-        advertise() on the topic first.
+        advertise() on the topic first.  This never blocks.
+
+        Our own subscribers get the message object itself, and it is only
+        serialized if somebody else is listening.
+
+        This may be called from any thread.  Messages from threads other than
+        the one running the event loop are serialized by the calling thread,
+        and sent from the event loop.
 
         Parameters
         ----------
@@ -437,10 +1040,537 @@ class DZMQ(object):
             Name of topic.
         msg : str or dict
             Mesage to send.
+
+        Returns
+        -------
+        out : bool
+            True if the message was queued, False if it was dropped due to
+            the topic's rate limit or, for nodrop topics, a full send queue.
+            From other threads, True only means that the message was handed
+            to the event loop, which may still drop it; False means that the
+            topic isn't advertised or too many messages are waiting.
+        """
+        if threading.current_thread() is not self._loop_thread:
+            return self._publish_threaded(topic, msg)
+        return self._publish(topic, msg)
+
+    def _publish(self, topic, msg, body=None):
+        """
+        Internal method to publish a message from the event loop thread,
+        given its packed body if we have it already.
+        """
+        for p in self.publishers:
+            if p['topic'] == topic:
+                if not self._take_token(p):
+                    self._count_dropped(p)
+                    return False
+                local = self._local_subscribers(p)
+                remote = bool(self._listeners.get(topic))
+                rates = self._due_rates(p)
+                frames = None
+                if remote or rates or [s for s in local if s['raw']]:
+                    frames = self._pack_frames(p, msg, body)
+                if local:
+                    self._publish_local(local, msg, frames)
+                if rates:
+                    header, body = p['header'], frames[2]
+                    if frames[1][:1] == PUB_DELTA:
+                        # The decimated streams skip messages, so they only
+                        # get keyframes
+                        header, body = self._pack_delta(p, msg, key=True)
+                    self._send_rates(p, rates, header, body)
+                if not remote:
+                    p['sent'] += 1
+                    return True
+                return self._send(p, frames)
+        return False
+
+    def _due_rates(self, publisher):
+        """
+        Internal method to get the decimated streams of a topic that somebody
+        is listening to and that are due another message.
+        """
+        if not publisher['rates']:
+            return []
+        now = time.time()
+        return [r for r in publisher['rates'].values()
+                if self._listeners.get(r['topic']) and
+                self._rate_due(r, now)]
+
+    def _send_rates(self, publisher, rates, header, body):
+        """
+        Internal method to send a message on decimated streams of a topic.
+        """
+        for r in rates:
+            try:
+                publisher['socket'].send_multipart(
+                    (r['topic'].encode('utf-8'), header, body),
+                    zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                pass
+
+    def _rate_due(self, schedule, now):
+        """
+        Internal method to check whether a decimated stream is due another
+        message, and schedule the one after.
+        """
+        if now < schedule['next']:
+            return False
+        # Keep to the schedule, unless we've fallen behind by more than a
+        # period
+        next_time = schedule['next'] + schedule['period']
+        if next_time <= now:
+            next_time = now + schedule['period']
+        schedule['next'] = next_time
+        return True
+
+    def _add_rate(self, publisher, tag):
+        """
+        Internal method to start serving a decimated rate of a topic, or
+        note that it is still wanted.
+        """
+        rate = publisher['rates'].get(tag)
+        if rate is None:
+            rate = {}
+            rate['topic'] = _rate_topic(publisher['topic'], tag)
+            rate['period'] = 1.0 / float(tag)
+            rate['next'] = 0.0
+            publisher['rates'][tag] = rate
+        rate['tstamp'] = time.time()
+
+    def _publish_threaded(self, topic, msg):
+        """
+        Internal method to pack a message on the calling thread, and queue it
+        for the event loop.
+        """
+        for p in self.publishers:
+            if p['topic'] == topic:
+                break
+        else:
+            return False
+        if len(self._thread_queue) >= THREAD_QUEUE_MAXSIZE:
+            self._count_dropped(p)
+            return False
+        # If nobody else is listening yet, leave it to the event loop to
+        # decide
+        body = None
+        if self._listeners.get(topic) and p['delta'] is None:
+            body = self._pack_body(p, msg)
+        self._thread_queue.append((topic, msg, body))
+
+        with self._thread_lock:
+            if not self._wakeup_pending:
+                self._wakeup_pending = True
+                try:
+                    self._doorbell.send(b'', zmq.NOBLOCK)
+                except zmq.Again:
+                    # The event loop has plenty of wake up calls already
+                    pass
+        return True
+
+    def _handle_thread_queue(self):
+        """
+        Internal method to send the messages queued by other threads.
+        """
+        with self._thread_lock:
+            while True:
+                try:
+                    self._collector.recv(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+            # Anything queued from here on rings again
+            self._wakeup_pending = False
+        for i in range(len(self._thread_queue)):
+            topic, msg, body = self._thread_queue.popleft()
+            self._publish(topic, msg, body)
+
+    def _pack_body(self, publisher, msg):
+        """
+        Internal method to serialize a message body.
+        """
+        if publisher['msg_type'] is not None:
+            return publisher['msg_type'].pack(msg)
+        return pack_msg(msg)
+
+    def _pack_frames(self, publisher, msg, body=None):
+        """
+        Internal method to serialize a message for the wire.
+        """
+        if (body is None and publisher['delta'] is not None and
+                isinstance(msg, np.ndarray) and not msg.dtype.hasobject and
+                msg.dtype.fields is None):
+            header, body = self._pack_delta(publisher, msg)
+            return (publisher['topic'].encode('utf-8'), header, body)
+        if body is None:
+            body = self._pack_body(publisher, msg)
+        header = self._stamp_trace(publisher, publisher['header'])
+        return (publisher['topic'].encode('utf-8'), header, body)
+
+    def _stamp_trace(self, publisher, header):
+        """
+        Internal method to add our sequence number and send time to a
+        message header, if the publisher is traced.
+        """
+        if not publisher['trace']:
+            return header
+        publisher['seq'] += 1
+        return header + TRACE_STRUCT.pack(self.guid.bytes, publisher['seq'],
+                                          time.time())
+
+    def _pack_delta(self, publisher, arr, key=False):
+        """
+        Internal method to encode an array as the difference from the one
+        published before it.  With key set, make a keyframe without touching
+        the publisher's state.
+        """
+        state = publisher['delta']
+        arr = np.ascontiguousarray(arr)
+        words = _as_words(arr)
+        count = 0
+        seq = 0
+        kind = DELTA_KEY
+        body = None
+        if not key:
+            state['seq'] += 1
+            seq = state['seq']
+            if not (state['key'] or state['count'] >= state['interval'] or
+                    state['dtype'] != arr.dtype or
+                    state['shape'] != arr.shape):
+                prev = state['words']
+                changed = np.flatnonzero(words != prev)
+                if (len(changed) * (4 + words.itemsize) <
+                        words.nbytes * DELTA_SPARSE_RATIO and
+                        len(words) < 2 ** 32):
+                    kind = DELTA_SPARSE
+                    count = len(changed)
+                    body = (changed.astype('<u4').tobytes() +
+                            words[changed].tobytes())
+                else:
+                    xor = zlib.compress(np.bitwise_xor(words, prev).tobytes(),
+                                        1)
+                    if len(xor) < words.nbytes * DELTA_XOR_RATIO:
+                        kind = DELTA_XOR
+                        body = xor
+            # Keep our own copy, since the caller may reuse the array
+            state['words'] = words.copy()
+            state['dtype'] = arr.dtype
+            state['shape'] = arr.shape
+            if kind == DELTA_KEY:
+                state['key'] = False
+                state['count'] = 0
+                body = state['words']
+            else:
+                state['count'] += 1
+        if body is None:
+            body = words.tobytes()
+        header = PUB_DELTA + DELTA_STRUCT.pack(self.guid.bytes, seq, kind,
+                                               count, arr.ndim)
+        header += struct.pack('<%dQ' % arr.ndim, *arr.shape)
+        header += arr.dtype.str.encode('utf-8')
+        return header, body
+
+    def _apply_delta(self, wire_topic, header, data):
+        """
+        Internal method to rebuild an array from a delta encoded message,
+        given the previous one from the same publisher.  Returns None if we
+        have to wait for a keyframe.
+        """
+        guid, seq, kind, count, ndim = DELTA_STRUCT.unpack_from(header, 1)
+        offset = 1 + DELTA_STRUCT.size
+        shape = struct.unpack_from('<%dQ' % ndim, header, offset)
+        dtype = np.dtype(header[offset + 8 * ndim:].decode('utf-8'))
+        key = (wire_topic, guid)
+        if kind == DELTA_KEY:
+            words = _as_words(np.frombuffer(data, dtype=dtype))
+        else:
+            state = self._delta_state.get(key)
+            if state is None or state['seq'] != seq - 1:
+                self._delta_state.pop(key, None)
+                self.log.debug('Waiting for a keyframe on %s' % wire_topic)
+                return None
+            prev = state['words']
+            if kind == DELTA_SPARSE:
+                changed = np.frombuffer(data, dtype='<u4', count=count)
+                words = prev.copy()
+                words[changed] = np.frombuffer(data, dtype=prev.dtype,
+                                               count=count, offset=4 * count)
+            else:
+                words = np.bitwise_xor(prev, np.frombuffer(
+                    zlib.decompress(data), dtype=prev.dtype))
+        self._delta_state[key] = {'seq': seq, 'words': words}
+        # The next delta applies to this array, so it must not change
+        msg = words.view(dtype).reshape(shape)
+        msg.flags.writeable = False
+        return msg
+
+    def _local_subscribers(self, publisher):
+        """
+        Internal method to find our own subscribers to a publisher's
+        messages.
+        """
+        type_hash = self._type_hash(publisher['msg_type'])
+        return [s for s in self._topic_trie.match(publisher['topic'])
+                if s['stream'] is None and
+                (s['raw'] or publisher['msg_type'] is None or
+                 (s['msg_type'] is not None and
+                  s['msg_type'].type_hash == type_hash))]
+
+    def _publish_local(self, subscribers, msg, frames=None):
+        """
+        Internal method to hand a message to our own subscribers without
+        serializing it.  Raw subscribers get the frames, if given.
+        """
+        view = None
+        raw_frames = None
+        now = time.time()
+        for s in subscribers:
+            if s['rate'] is not None and not self._rate_due(s, now):
+                continue
+            if s['raw']:
+                if raw_frames is None:
+                    raw_frames = [zmq.Frame(f) for f in frames]
+                func, args = s['cb'], (raw_frames,)
+            elif s['copy']:
+                func, args = self._deliver, (s, copy.deepcopy(msg))
+            else:
+                if view is None:
+                    view = _read_only(msg)
+                func, args = self._deliver, (s, view)
+            if s['queued']:
+                self._local_queue.append((func, args))
+            else:
+                func(*args)
+
+    def _count_dropped(self, publisher):
+        """
+        Internal method to count a dropped message, which may happen on any
+        thread.
+        """
+        with self._thread_lock:
+            publisher['dropped'] += 1
+
+    def _take_token(self, publisher):
+        """
+        Internal method to check a publisher's token bucket rate limit.
+        """
+        if publisher['rate'] is None:
+            return True
+        now = time.time()
+        tokens = publisher['tokens']
+        tokens += (now - publisher['tstamp']) * publisher['rate']
+        publisher['tokens'] = min(tokens, publisher['burst'])
+        publisher['tstamp'] = now
+        if publisher['tokens'] < 1:
+            return False
+        publisher['tokens'] -= 1
+        return True
+
+    def _send(self, publisher, frames):
+        """
+        Internal method to send a message without blocking, keeping count of
+        what gets dropped.
+        """
+        try:
+            publisher['socket'].send_multipart(frames, zmq.NOBLOCK,
+                                               copy=False)
+        except zmq.Again:
+            self._count_dropped(publisher)
+            if publisher['adaptive']:
+                publisher['rate'] = max(publisher['rate'] / 2,
+                                        ADAPTIVE_MIN_RATE)
+            return False
+        publisher['sent'] += 1
+        if publisher['adaptive'] and publisher['rate'] < publisher['max_rate']:
+            publisher['rate'] = min(publisher['rate'] + ADAPTIVE_INCREASE *
+                                    publisher['max_rate'],
+                                    publisher['max_rate'])
+        return True
+
+    def publish_stream(self, topic, source, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Publish a large payload on the given topic as a stream of chunks, to
+        be received with subscribe_stream().  You should have called
+        advertise() on the topic first.
+
+        Files are mapped into memory rather than read, and chunks are sent
+        without copying, a few at a time from the event loop, so memory use
+        does not grow with the size of the payload.  Keep spinning until the
+        stream has gone out.
+
+        Parameters
+        ----------
+        topic : str
+            Name of topic.
+        source : file, bytes-like, or iterable of bytes-like
+            Payload.  A file must be opened for reading in binary mode.
+        chunk_size : int, optional
+            Maximum chunk size in bytes.
+
+        Returns
+        -------
+        out : int
+            Stream ID, unique to this publisher, or None if the topic is not
+            advertised.
+        """
+        for p in self.publishers:
+            if p['topic'] == topic:
+                break
+        else:
+            return None
+        self._stream_count += 1
+        stream = {}
+        stream['publisher'] = p
+        stream['id'] = self._stream_count
+        stream['index'] = 0
+        stream['chunks'] = self._iter_chunks(source, chunk_size)
+        stream['trackers'] = []
+        # Look one chunk ahead so we know which one is the last.  An empty
+        # payload is sent as one empty chunk.
+        stream['pending'] = next(stream['chunks'], None)
+        if stream['pending'] is None:
+            stream['pending'] = b''
+        stream['upcoming'] = next(stream['chunks'], None)
+        self._send_stream(stream)
+        return stream['id']
+
+    def _iter_chunks(self, source, chunk_size):
+        """
+        Internal method to split a stream payload into buffers of at most
+        chunk_size bytes.
+        """
+        if hasattr(source, 'fileno'):
+            if os.fstat(source.fileno()).st_size:
+                # The map is closed once the last chunk is released
+                source = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                source = b''
+        if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+            source = [source]
+        for item in source:
+            view = memoryview(item)
+            if view.ndim != 1 or view.itemsize != 1:
+                view = view.cast('B')
+            for offset in range(0, len(view), chunk_size):
+                yield view[offset:offset + chunk_size]
+
+    def _send_stream(self, stream):
+        """
+        Internal method to send the next chunks of a stream, and schedule
+        the rest.
+        """
+        p = stream['publisher']
+        if p not in self.publishers:
+            # The topic was unadvertised
+            return
+        topic = p['topic'].encode('utf-8')
+        local = [s for s in self._topic_trie.match(p['topic'])
+                 if s['stream'] is not None]
+        for i in range(STREAM_CHUNKS_PER_SPIN):
+            stream['trackers'] = [t for t in stream['trackers'] if not t.done]
+            if len(stream['trackers']) >= STREAM_MAX_INFLIGHT:
+                break
+            chunk = (self.guid.bytes, stream['id'], stream['index'],
+                     stream['upcoming'] is None)
+            if self._listeners.get(p['topic']):
+                header = PUB_CHUNK + CHUNK_STRUCT.pack(*chunk)
+                try:
+                    tracker = p['socket'].send_multipart(
+                        (topic, header, stream['pending']), zmq.NOBLOCK,
+                        copy=False, track=True)
+                except zmq.Again:
+                    break
+                stream['trackers'].append(tracker)
+            for s in local:
+                self._handle_chunk(s, p['topic'], chunk,
+                                   memoryview(stream['pending']))
+            stream['index'] += 1
+            stream['pending'] = stream['upcoming']
+            if stream['pending'] is None:
+                return
+            stream['upcoming'] = next(stream['chunks'], None)
+        else:
+            # Let everything else have a turn
+            self.call_later(0, lambda: self._send_stream(stream))
+            return
+        # Wait for the send queue to drain
+        self.call_later(STREAM_RETRY_PERIOD, lambda: self._send_stream(stream))
+
+    def get_publish_stats(self, topic):
+        """
+        Get the number of messages sent and dropped for a topic.
+
+        Parameters
+        ----------
+        topic : str
+            Name of topic.
+
+        Returns
+        -------
+        out : dict
+            Numbers of messages 'sent' and 'dropped', and the current 'rate'
+            limit, or None if the topic is not advertised.
         """
-        if [p for p in self.publishers if p['topic'] == topic]:
-            msg = pack_msg(msg)
-            self.pub_socket.send_multipart((topic.encode('utf-8'), PUB_MSG, msg))
+        for p in self.publishers:
+            if p['topic'] == topic:
+                return {'sent': p['sent'], 'dropped': p['dropped'],
+                        'rate': p['rate']}
+
+    def forward(self, frames, topic=None):
+        """
+        Republish a message received by a raw subscriber without unpacking
+        or copying it.  You should have called advertise() on the topic
+        first.  The upstream publisher's trace is replaced by our own, if the
+        topic is traced.
+
+        Parameters
+        ----------
+        frames : list of zmq.Frame
+            Message frames, as passed to a raw subscriber callback.
+        topic : str, optional
+            Topic to republish on.  By default, use the original topic.
+
+        Returns
+        -------
+        out : bool
+            True if the message was queued, False if it was dropped.
+        """
+        if topic is None:
+            topic = frames[0].bytes.decode('utf-8')
+        for p in self.publishers:
+            if p['topic'] == topic:
+                if not self._take_token(p):
+                    self._count_dropped(p)
+                    return False
+                header = frames[1].bytes
+                mtype = header[:1]
+                if mtype in (PUB_MSG, PUB_STRUCT):
+                    # Loss and latency are accounted for per link, so the
+                    # upstream trace is no use downstream
+                    if mtype == PUB_STRUCT:
+                        header = header[:1 + TYPE_HASH_LENGTH]
+                    else:
+                        header = header[:1]
+                    self._send_rates(p, self._due_rates(p), header, frames[2])
+                    header = zmq.Frame(self._stamp_trace(p, header))
+                else:
+                    # The decimated streams skip messages, so they only get
+                    # keyframes, and streams aren't decimated at all
+                    if (mtype == PUB_DELTA and
+                            DELTA_STRUCT.unpack_from(header, 1)[2] ==
+                            DELTA_KEY):
+                        self._send_rates(p, self._due_rates(p), frames[1],
+                                         frames[2])
+                    header = frames[1]
+                frames = [zmq.Frame(topic.encode('utf-8')), header] + list(
+                    frames[2:])
+                if self._topic_trie.match(topic):
+                    self._local_queue.append((self._handle_sub_recv,
+                                              (frames,)))
+                if not self._listeners.get(topic):
+                    p['sent'] += 1
+                    return True
+                return self._send(p, frames)
+        return False
 
     def _handle_bcast_recv(self, msg):
         """
@@ -455,11 +1585,8 @@ class DZMQ(object):
                 self.log.warn('Warning: mismatched protocol versions: %d != %d'
                               % (version, VERSION))
             offset += 2
-            guid_int = 0
-            for i in range(0, GUID_LENGTH):
-                guid_int += struct.unpack_from('<B', data, offset)[0] << 8 * i
-                offset += 1
-            guid = uuid.UUID(int=guid_int)
+            guid = uuid.UUID(bytes=bytes(data[offset:offset + GUID_LENGTH]))
+            offset += GUID_LENGTH
             topiclength = struct.unpack_from('<B', data, offset)[0]
             offset += 1
             topic = data[offset:offset + topiclength].decode('utf-8')
@@ -470,6 +1597,7 @@ class DZMQ(object):
             offset += FLAGS_LENGTH
 
             if op == OP_ADV:
+                self._touch_peer(guid)
                 # Unpack the ADV body
                 adv = {}
                 adv['topic'] = topic
@@ -480,9 +1608,18 @@ class DZMQ(object):
                 addr = data[offset:offset + addresslength]
                 adv['address'] = addr.decode('utf-8')
                 offset += addresslength
-
-                # Are we interested in this topic?
-                if [s for s in self.subscribers if s['topic'] == adv['topic']]:
+                adv['ctl_address'] = None
+                if offset < len(data):
+                    addresslength = struct.unpack_from('<H', data, offset)[0]
+                    offset += 2
+                    addr = data[offset:offset + addresslength]
+                    adv['ctl_address'] = addr.decode('utf-8')
+                    offset += addresslength
+
+                # Are we interested in this topic, and do we agree on its
+                # message type?
+                type_hash = bytes(bytearray(flags[TYPE_HASH_OFFSET:]))
+                if self._type_compatible(adv['topic'], type_hash):
                     # Yes, we're interested; make a connection
                     self._connect_subscriber(adv)
 
@@ -490,24 +1627,33 @@ class DZMQ(object):
                 # The SUB body is NULL
                 # If we're publishing this topic, re-advertise it to allow the
                 # new subscriber to find us.
-                [self._advertise(p) for p in self.publishers
-                 if p['topic'] == topic]
-
-            elif op == OP_SYN:
-                # unpack the SYN body
-                addresslength = struct.unpack_from('<H', data, offset)[0]
-                offset += 2
-                pub_addr = data[offset:offset + addresslength].decode('utf-8')
-                offset += addresslength
+                prefix = bool(flags[0] & FLAG_PREFIX)
+                rate = RATE_STRUCT.unpack(bytes(bytearray(
+                    flags[RATE_OFFSET:RATE_OFFSET + RATE_STRUCT.size])))[0]
+                for p in self.publishers:
+                    if topic_matches(topic, p['topic'], prefix):
+                        if rate > 0:
+                            self._add_rate(p, _rate_tag(rate))
+                        self._advertise(p)
+                if topic in self.services:
+                    self._advertise_service(self.services[topic])
+
+            elif op == OP_UNADV:
+                # The publisher has stopped publishing this topic
+                [self._drop_connection(c) for c in list(self.sub_connections)
+                 if c['topic'] == topic and c['guid'] == guid]
+
+            elif op == OP_SRV:
+                # Unpack the service address, and note it if we've been
+                # looking for this service
                 addresslength = struct.unpack_from('<H', data, offset)[0]
                 offset += 2
-                sub_addr = data[offset:offset + addresslength].decode('utf-8')
+                address = data[offset:offset + addresslength].decode('utf-8')
                 offset += addresslength
-
-                if pub_addr == self.address and not sub_addr == self.address:
-                    if topic not in self._listeners:
-                        self._listeners[topic] = dict()
-                    self._listeners[topic][sub_addr] = time.time()
+                if (topic in self._srv_providers or
+                        [r for r in self._srv_requests.values()
+                         if r['name'] == topic]):
+                    self._srv_providers[topic][address] = time.time()
 
             else:
                 self.log.warn('Warning: got unrecognized OP: %d' % op)
@@ -517,68 +1663,934 @@ class DZMQ(object):
             self.log.warn('Warning: exception while processing SUB or ADV '
                           'message: %s' % e)
 
+    def _type_hash(self, msg_type):
+        """
+        Internal method to get the hash we advertise for a message type.
+        """
+        if msg_type is None:
+            return b'\x00' * TYPE_HASH_LENGTH
+        return msg_type.type_hash
+
+    def _type_compatible(self, topic, type_hash):
+        """
+        Internal method to check whether any of our subscribers to a topic
+        can read messages of the advertised type.
+        """
+        subs = self._topic_trie.match(topic)
+        if not subs:
+            return False
+        # Messages of a fixed layout type can only be decoded with that type
+        for s in subs:
+            if (s['raw'] or s['stream'] is not None or
+                    not any(bytearray(type_hash)) or
+                    (s['msg_type'] is not None and
+                     s['msg_type'].type_hash == type_hash)):
+                return True
+        self.log.warn('Warning: ignoring %s due to mismatched message type'
+                      % topic)
+        return False
+
     def _connect_subscriber(self, adv):
         """
         Internal method to connect to a publisher.
         """
-        # Choose the best address to use.  If the publisher's GUID is the same
-        # as our GUID, then we must both be in the same process, in which case
-        # we'd like to use an 'inproc://' address.  Otherwise, fall back on
-        # 'tcp://'.
-        if adv['address'].startswith(('tcp', 'ipc')):
-            if adv['guid'] == self.guid:
-                # Us; skip it
-                return
-        elif adv['address'].startswith('inproc'):
-            if adv['guid'] != self.guid:
-                # Not us; skip it
-                return
-        else:
+        # Our own publications are delivered without going through zmq (see
+        # _publish_local)
+        if adv['guid'] == self.guid:
+            return
+        if not adv['address'].startswith(('tcp', 'ipc')):
             self.log.warn('Warning: ignoring unknown address type: %s' %
                           (adv['address']))
             return
 
-        # Are we already connected to this publisher for this topic?
-        if [c for c in self.sub_connections
-                if c['topic'] == adv['topic'] and c['guid'] == adv['guid']]:
+        # Is this address still in use by a publisher that has since been
+        # restarted?  Then the old one is gone.
+        for c in list(self.sub_connections):
+            if c['address'] == adv['address'] and c['guid'] != adv['guid']:
+                self._forget_peer(c['guid'], 'restarted')
+
+        # We need one connection for each rate our subscribers want
+        rates = set(s['rate'] for s in self._topic_trie.match(adv['topic']))
+        for rate in rates:
+            # Are we already connected to this publisher for this topic?
+            if [c for c in self.sub_connections
+                    if c['topic'] == adv['topic'] and
+                    c['guid'] == adv['guid'] and c['rate'] == rate]:
+                continue
+
+            # Connect our subscriber socket
+            conn = {}
+            conn['socket'] = self.sub_socket
+            conn['topic'] = adv['topic']
+            conn['rate'] = rate
+            conn['wire_topic'] = _rate_topic(adv['topic'], rate)
+            conn['address'] = adv['address']
+            conn['guid'] = adv['guid']
+            conn['ctl_address'] = adv.get('ctl_address')
+            conn['synched'] = False
+            conn['socket'].setsockopt(zmq.SUBSCRIBE,
+                                      conn['wire_topic'].encode('utf-8'))
+
+            if not any([s['address'] == adv['address']
+                        for s in self.sub_connections]):
+                conn['socket'].connect(adv['address'])
+
+            self.sub_connections.append(conn)
+            self.log.info('Connected to %s for %s (%s != %s)' %
+                          (adv['address'], conn['wire_topic'], adv['guid'],
+                           self.guid))
+            if rate is not None:
+                # Make sure the publisher knows about the rate, even if it
+                # missed our subscription
+                self._subscribe({'topic': adv['topic'], 'rate': rate})
+
+    def _touch_peer(self, guid):
+        """
+        Internal method to note that we've heard from a peer.
+        """
+        if guid == self.guid:
+            return
+        peer = self._peers.get(guid)
+        if peer is None:
+            peer = {}
+            peer['guid'] = guid
+            peer['first_seen'] = time.time()
+            self._peers[guid] = peer
+            self._peer_stats['joined'] += 1
+        peer['last_seen'] = time.time()
+
+    def _touch_connections(self, key, value):
+        """
+        Internal method to note that we've heard from the peers behind the
+        connections with a given address or control address.
+        """
+        for guid in set(c['guid'] for c in self.sub_connections
+                        if c[key] == value):
+            self._touch_peer(guid)
+
+    def _touch_publisher(self, wire_topic, guid=None):
+        """
+        Internal method to note that we've received data on a topic.  The
+        SUB socket doesn't tell us which connection it came in on, so credit
+        the publisher named in the header if we're connected to it, or else
+        every publisher of the topic.
+        """
+        guids = set(c['guid'] for c in self.sub_connections
+                    if c['wire_topic'] == wire_topic)
+        if guid is not None and uuid.UUID(bytes=guid) in guids:
+            guids = [uuid.UUID(bytes=guid)]
+        [self._touch_peer(g) for g in guids]
+
+    def _forget_peer(self, guid, reason):
+        """
+        Internal method to drop a peer and all of our connections to it.
+        """
+        peer = self._peers.pop(guid, None)
+        if peer is not None:
+            self._peer_stats[reason] += 1
+            self.log.info('Peer %s %s' % (guid, reason))
+        [self._drop_connection(c) for c in list(self.sub_connections)
+         if c['guid'] == guid]
+        for key in [k for k in self._delta_state if k[1] == guid.bytes]:
+            del self._delta_state[key]
+
+    def _expire_peers(self):
+        """
+        Internal method to forget the peers that have gone quiet.
+        """
+        now = time.time()
+        [self._forget_peer(guid, 'expired')
+         for (guid, peer) in list(self._peers.items())
+         if (now - peer['last_seen']) > PEER_TIMEOUT]
+
+    def get_peer_stats(self):
+        """
+        Get the number of publishers we know of, and how they come and go.
+
+        Returns
+        -------
+        out : dict
+            Numbers of live 'peers' and data 'connections', and of peers
+            that have 'joined', 'expired' after going quiet, or been
+            'restarted' under a new GUID.
+        """
+        stats = dict(self._peer_stats)
+        stats['peers'] = len(self._peers)
+        stats['connections'] = len(self.sub_connections)
+        return stats
+
+    def _drop_connection(self, conn):
+        """
+        Internal method to stop receiving a topic from a publisher.
+        """
+        self.sub_connections.remove(conn)
+        # zmq counts subscriptions, so this only undoes the SUBSCRIBE made for
+        # this connection
+        conn['socket'].setsockopt(zmq.UNSUBSCRIBE,
+                                  conn['wire_topic'].encode('utf-8'))
+        if not [c for c in self.sub_connections
+                if c['address'] == conn['address']]:
+            try:
+                conn['socket'].disconnect(conn['address'])
+            except zmq.ZMQError:
+                # The endpoint is already gone
+                pass
+
+        ctl_address = conn['ctl_address']
+        sock = self._ctl_sockets.get(ctl_address)
+        if sock is not None:
+            if conn['synched']:
+                # Let the publisher forget us without waiting for a timeout
+                try:
+                    sock.send_multipart((CTL_UNSUB,
+                                         conn['wire_topic'].encode('utf-8'),
+                                         self.address.encode('utf-8')),
+                                        zmq.NOBLOCK)
+                except zmq.Again:
+                    pass
+            if not [c for c in self.sub_connections
+                    if c['ctl_address'] == ctl_address]:
+                del self._ctl_sockets[ctl_address]
+                self.poller.unregister(sock)
+                sock.close(linger=CTL_LINGER)
+        self.log.info('Disconnected from %s for %s' %
+                      (conn['address'], conn['wire_topic']))
+
+    def _bind(self, sock, suffix):
+        """
+        Internal method to bind an auxiliary socket next to our main address.
+        """
+        if self.address.startswith('ipc'):
+            addr = '%s-%s' % (self.address, suffix)
+            sock.bind(addr)
+            return addr
+        tcp_addr = 'tcp://%s' % (self.ipaddr)
+        tcp_port = sock.bind_to_random_port(tcp_addr)
+        return tcp_addr + ':%d' % (tcp_port)
+
+    def _advertise_service(self, service):
+        """
+        Internal method to pack and broadcast a service advertisement.
+        """
+        msg = self._pack_header(service['name'], OP_SRV)
+        msg += struct.pack('<H', len(self.srv_address))
+        msg += self.srv_address.encode('utf-8')
+        self.bcast_send.sendto(msg, (self.bcast_host, self.bcast_port))
+
+    def advertise_service(self, name, handler, concurrency=0):
+        """
+        Advertise a request/reply service.  Requests will be passed to the
+        handler, which should have the signature: handler(req), and return
+        the reply.
+
+        Parameters
+        ----------
+        name : str
+            Service name.
+        handler : callable
+            Callable that accepts one argument (req) and returns the reply.
+        concurrency : int, optional
+            Number of worker threads to run the handler in.  By default, the
+            handler is called directly from the event loop.
+        """
+        if len(name) > TOPIC_MAXLENGTH:
+            raise Exception('Service name length %d exceeds maximum %d'
+                            % (len(name), TOPIC_MAXLENGTH))
+        if self.srv_socket is None:
+            self.srv_socket = self.context.socket(zmq.ROUTER)
+            self.srv_socket.setsockopt(zmq.LINGER, 0)
+            self.srv_address = self._bind(self.srv_socket, 'srv')
+            self.poller.register(self.srv_socket, zmq.POLLIN)
+
+        service = {}
+        service['name'] = name
+        service['handler'] = handler
+        service['threads'] = []
+        if concurrency:
+            if self._srv_reply_socket is None:
+                self._srv_reply_socket = self.context.socket(zmq.PULL)
+                self._srv_reply_socket.setsockopt(zmq.LINGER, 0)
+                self._srv_reply_socket.bind(self._srv_reply_addr)
+                self.poller.register(self._srv_reply_socket, zmq.POLLIN)
+            service['queue'] = queue.Queue()
+            for i in range(concurrency):
+                thread = threading.Thread(target=self._service_worker,
+                                          args=(service,))
+                thread.daemon = True
+                thread.start()
+                service['threads'].append(thread)
+        self.services[name] = service
+        self._advertise_service(service)
+
+        # We can serve ourselves without waiting for the broadcast
+        self._srv_providers[name][self.srv_address] = time.time()
+
+    def unadvertise_service(self, name):
+        """
+        Stop providing a service.
+
+        Parameters
+        ----------
+        name : str
+            Service name.
+        """
+        service = self.services.pop(name, None)
+        if service is None:
             return
+        [service['queue'].put(None) for t in service['threads']]
+        self._srv_providers[name].pop(self.srv_address, None)
+
+    def _run_handler(self, service, body):
+        """
+        Internal method to invoke a service handler on a packed request.
+        """
+        try:
+            reply = service['handler'](unwrap_msg(unpack_msg(body)))
+            return SRV_OK, pack_msg(reply)
+        except Exception as e:
+            self.log.exception(e)
+            return SRV_ERR, pack_msg('%s: %s' % (type(e).__name__, e))
 
-        # Are we already connected to this publisher for this topic
-        # on this address?
-        for c in self.sub_connections:
-            if c['topic'] == adv['topic'] and c['address'] == adv['address']:
-                c['guid'] == adv['guid']
+    def _service_worker(self, service):
+        """
+        Internal method run by service worker threads.
+        """
+        # zmq sockets may not be shared between threads, so each worker
+        # pushes its replies back to the event loop on its own socket.
+        sock = self.context.socket(zmq.PUSH)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(self._srv_reply_addr)
+        try:
+            while True:
+                item = service['queue'].get()
+                if item is None:
+                    break
+                ident, req_id, body = item
+                status, reply = self._run_handler(service, body)
+                sock.send_multipart((ident, req_id, status, reply))
+        except zmq.ZMQError:
+            # Our context was closed under us
+            pass
+        finally:
+            sock.close()
+
+    def _handle_srv_request(self):
+        """
+        Internal method to handle all pending incoming service requests.
+        """
+        while True:
+            try:
+                ident, req_id, name, body = self.srv_socket.recv_multipart(
+                    zmq.NOBLOCK)
+            except zmq.Again:
                 return
+            name = name.decode('utf-8')
+            service = self.services.get(name)
+            if service is None:
+                status = SRV_ERR
+                reply = pack_msg('No such service: %s' % name)
+            elif service['threads']:
+                service['queue'].put((ident, req_id, body))
+                continue
+            else:
+                status, reply = self._run_handler(service, body)
+            self.srv_socket.send_multipart((ident, req_id, status, reply))
+
+    def _get_peer_socket(self, address, pool=None):
+        """
+        Internal method to get our pooled DEALER connection to a peer.
+        """
+        if pool is None:
+            pool = self._peer_sockets
+        sock = pool.get(address)
+        if sock is None:
+            sock = self.context.socket(zmq.DEALER)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(address)
+            self.poller.register(sock, zmq.POLLIN)
+            pool[address] = sock
+        return sock
+
+    def _get_provider(self, name):
+        """
+        Internal method to pick the least loaded live provider of a service.
+        """
+        now = time.time()
+        providers = [addr for (addr, tstamp)
+                     in self._srv_providers[name].items()
+                     if (now - tstamp) < SRV_EXPIRE_PERIOD]
+        if not providers:
+            return
+        # Rotate through equally loaded providers
+        start = self._srv_count % len(providers)
+        providers = providers[start:] + providers[:start]
+        return min(providers, key=lambda addr: self._srv_inflight[addr])
+
+    def _send_srv_request(self, req_id, request):
+        """
+        Internal method to send a request to a provider, if we know of one.
+        """
+        address = self._get_provider(request['name'])
+        if address is None:
+            return
+        request['address'] = address
+        self._srv_inflight[address] += 1
+        sock = self._get_peer_socket(address)
+        sock.send_multipart((req_id, request['name'].encode('utf-8'),
+                             request['body']))
+
+    def call_async(self, name, req, cb, timeout=None):
+        """
+        Call a service without waiting for the reply.  The callback will be
+        invoked from the event loop with the signature: cb(reply, error),
+        where error is None on success or a ServiceError instance.
+
+        Parameters
+        ----------
+        name : str
+            Service name.
+        req : str or dict
+            Request to send.
+        cb : callable
+            Callable that accepts two arguments (reply, error).
+        timeout : float, optional
+            Timeout in seconds.  By default, wait as long as the provider is
+            alive.
+
+        Returns
+        -------
+        out : bytes
+            The request id.
+        """
+        self._srv_count += 1
+        req_id = struct.pack('<Q', self._srv_count)
+        request = {}
+        request['name'] = name
+        request['body'] = pack_msg(req)
+        request['cb'] = cb
+        request['address'] = None
+        self._srv_requests[req_id] = request
+        if timeout is not None:
+            self.call_later(timeout, lambda: self._expire_srv_request(req_id))
+        self._send_srv_request(req_id, request)
+        if request['address'] is None:
+            # Ask the providers to make themselves known
+            self._srv_waiting.add(req_id)
+            self._subscribe({'topic': name})
+        return req_id
+
+    def call(self, name, req, timeout=SRV_CALL_TIMEOUT):
+        """
+        Call a service and wait for the reply, spinning the event loop in the
+        meantime.
+
+        Parameters
+        ----------
+        name : str
+            Service name.
+        req : str or dict
+            Request to send.
+        timeout : float, optional
+            Timeout in seconds, or None to wait as long as the provider is
+            alive.
+
+        Returns
+        -------
+        out : object
+            The reply returned by the service handler.
+        """
+        result = {}
 
-        # Connect our subscriber socket
-        conn = {}
-        conn['socket'] = self.sub_socket
-        conn['topic'] = adv['topic']
-        conn['address'] = adv['address']
-        conn['guid'] = adv['guid']
-        conn['socket'].setsockopt(zmq.SUBSCRIBE, adv['topic'].encode('utf-8'))
+        def cb(reply, error):
+            result['reply'] = reply
+            result['error'] = error
 
-        if not any([s['address'] == adv['address']
-                    for s in self.sub_connections]):
-            conn['socket'].connect(adv['address'])
+        self.call_async(name, req, cb, timeout)
+        while not result:
+            self.spinOnce(0.001)
+        if result['error'] is not None:
+            raise result['error']
+        return result['reply']
 
-        self.sub_connections.append(conn)
-        self.log.info('Connected to %s for %s (%s != %s)' %
-                      (adv['address'], adv['topic'], adv['guid'], self.guid))
+    def _handle_srv_reply(self, sock):
+        """
+        Internal method to handle all pending replies on a peer connection.
+        """
+        while True:
+            try:
+                req_id, status, body = sock.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            request = self._srv_requests.pop(req_id, None)
+            if request is None:
+                # We already gave up on this one
+                continue
+            self._srv_inflight[request['address']] -= 1
+            reply = unwrap_msg(unpack_msg(body))
+            if status == SRV_OK:
+                request['cb'](reply, None)
+            else:
+                request['cb'](None, ServiceError(reply))
+
+    def _expire_srv_request(self, req_id):
+        """
+        Internal method to give up on a request that has timed out.
+        """
+        request = self._srv_requests.pop(req_id, None)
+        if request is None:
+            # It has been answered already
+            return
+        self._srv_waiting.discard(req_id)
+        if request['address'] is not None:
+            self._srv_inflight[request['address']] -= 1
+        request['cb'](None, ServiceError('Service call to %s timed out'
+                                         % request['name']))
+
+    def _expire_srv_providers(self):
+        """
+        Internal method to forget the service providers that have gone quiet,
+        failing the requests they still owe us, and close our connections to
+        them.
+        """
+        now = time.time()
+        for (name, providers) in self._srv_providers.items():
+            for (address, tstamp) in list(providers.items()):
+                if address == self.srv_address and name in self.services:
+                    continue
+                if (now - tstamp) > SRV_EXPIRE_PERIOD:
+                    del providers[address]
+        for (req_id, request) in list(self._srv_requests.items()):
+            address = request['address']
+            if (address is not None and
+                    address not in self._srv_providers[request['name']]):
+                del self._srv_requests[req_id]
+                self._srv_inflight[address] -= 1
+                request['cb'](None, ServiceError(
+                    'Provider of %s at %s went away' % (request['name'],
+                                                        address)))
+        live = set(address for providers in self._srv_providers.values()
+                   for address in providers)
+        for address in [a for a in self._peer_sockets if a not in live]:
+            sock = self._peer_sockets.pop(address)
+            self.poller.unregister(sock)
+            sock.close()
+            self._srv_inflight.pop(address, None)
+
+    def _check_srv_requests(self):
+        """
+        Internal method to send requests that were waiting for a provider.
+        """
+        for req_id in list(self._srv_waiting):
+            self._send_srv_request(req_id, self._srv_requests[req_id])
+            if self._srv_requests[req_id]['address'] is not None:
+                self._srv_waiting.discard(req_id)
 
     def get_listeners(self, topic):
         """
         Get a list of current listeners for a given topic.
 
+        Subscribers to decimated rates of the topic are included.
+
         Parameters
         ----------
         topic : str
             Name of topic.
         """
-        if topic not in self._listeners:
+        names = [topic] + [r['topic'] for p in self.publishers
+                           if p['topic'] == topic
+                           for r in p['rates'].values()]
+        names = [name for name in names if name in self._listeners]
+        if not names:
+            return
+        now = time.time()
+        return [addr for name in names
+                for (addr, tstamp) in self._listeners[name].items()
+                if (now - tstamp) < 2 * HB_REPEAT_PERIOD]
+
+    def _deliver(self, subscriber, msg):
+        """
+        Internal method to hand a decoded message to a subscriber.
+        """
+        batch = subscriber['batch']
+        if batch is None:
+            subscriber['cb'](msg)
+            return
+
+        # Stack same shape arrays as they come in, and fall back on a list
+        # for anything else
+        if (batch['count'] and batch['stacked'] and
+                not self._stackable(msg, batch['array'])):
+            self._flush_batch(subscriber)
+        if not batch['count']:
+            batch['timer'] = self.call_later(
+                batch['max_latency'], lambda: self._flush_batch(subscriber))
+            batch['stacked'] = np is not None and isinstance(msg, np.ndarray)
+            if batch['stacked'] and not self._stackable(msg, batch['array']):
+                batch['array'] = np.empty((batch['max_batch'],) + msg.shape,
+                                          dtype=msg.dtype)
+        if batch['stacked']:
+            batch['array'][batch['count']] = msg
+        else:
+            batch['msgs'].append(msg)
+        batch['count'] += 1
+        if batch['count'] >= batch['max_batch']:
+            self._flush_batch(subscriber)
+
+    def _stackable(self, msg, array):
+        """
+        Internal method to check whether a message fits in a batch array.
+        """
+        return (array is not None and isinstance(msg, np.ndarray) and
+                msg.shape == array.shape[1:] and msg.dtype == array.dtype)
+
+    def _flush_batch(self, subscriber):
+        """
+        Internal method to deliver a subscriber's pending batch.
+        """
+        batch = subscriber['batch']
+        if not batch['count']:
+            return
+        self.cancel_timer(batch['timer'])
+        if batch['stacked']:
+            msgs = batch['array'][:batch['count']]
+        else:
+            msgs = batch['msgs']
+            batch['msgs'] = []
+        batch['count'] = 0
+        subscriber['cb'](msgs)
+
+    def _handle_chunk(self, subscriber, topic, chunk, data):
+        """
+        Internal method to hand a stream chunk to a subscriber, and reassemble
+        the stream.
+        """
+        guid, stream_id, index, last = chunk
+        stream = subscriber['stream']
+        key = (topic, guid, stream_id)
+        partial = stream['partial'].get(key)
+        if partial is None:
+            if index != 0:
+                # We joined part way through
+                return
+            partial = {}
+            partial['index'] = 0
+            partial['size'] = 0
+            partial['data'] = bytearray() if subscriber['cb'] else None
+            partial['tstamp'] = time.time()
+            partial['timer'] = self.call_later(
+                stream['timeout'],
+                lambda: self._expire_stream(subscriber, key))
+            stream['partial'][key] = partial
+        elif index != partial['index']:
+            self.log.warn('Warning: dropping stream %d on %s, missing chunk %d'
+                          % (stream_id, topic, partial['index']))
+            self._drop_stream(subscriber, key)
+            return
+        partial['size'] += len(data)
+        if (partial['data'] is not None and
+                partial['size'] > stream['max_size']):
+            self.log.warn('Warning: dropping stream %d on %s, size exceeds '
+                          '%d bytes' % (stream_id, topic, stream['max_size']))
+            self._drop_stream(subscriber, key)
+            return
+        partial['index'] += 1
+        partial['tstamp'] = time.time()
+        if stream['chunk_cb'] is not None:
+            stream['chunk_cb'](stream_id, index, data, last)
+        if partial['data'] is not None:
+            partial['data'] += data
+        if last:
+            self._drop_stream(subscriber, key)
+            if partial['data'] is not None:
+                subscriber['cb'](partial['data'])
+
+    def _drop_stream(self, subscriber, key):
+        """
+        Internal method to forget a partially received stream.
+        """
+        partial = subscriber['stream']['partial'].pop(key)
+        self.cancel_timer(partial['timer'])
+
+    def _expire_stream(self, subscriber, key):
+        """
+        Internal method to drop a stream whose chunks have stopped coming.
+        """
+        stream = subscriber['stream']
+        partial = stream['partial'].get(key)
+        if partial is None:
+            return
+        idle = time.time() - partial['tstamp']
+        if idle < stream['timeout']:
+            partial['timer'] = self.call_later(
+                stream['timeout'] - idle,
+                lambda: self._expire_stream(subscriber, key))
+            return
+        self.log.warn('Warning: dropping stream %d on %s, timed out'
+                      % (key[2], key[0]))
+        self._drop_stream(subscriber, key)
+
+    def _record_trace(self, topic, ext):
+        """
+        Internal method to account for a message's trace extension.
+        """
+        now = time.time()
+        guid, seq, tstamp = TRACE_STRUCT.unpack(ext)
+        stats = self._link_stats.get((topic, guid))
+        if stats is None:
+            stats = {}
+            stats['received'] = 0
+            stats['lost'] = 0
+            stats['reordered'] = 0
+            stats['last_seq'] = seq - 1
+            stats['latency_sum'] = 0.0
+            stats['latency_max'] = 0.0
+            stats['histogram'] = [0] * LATENCY_BUCKETS
+            self._link_stats[(topic, guid)] = stats
+        stats['received'] += 1
+        if seq > stats['last_seq']:
+            stats['lost'] += seq - stats['last_seq'] - 1
+            stats['last_seq'] = seq
+        else:
+            # Late arrival of a message we counted as lost
+            stats['reordered'] += 1
+            stats['lost'] = max(stats['lost'] - 1, 0)
+        latency = now - tstamp
+        stats['latency_sum'] += latency
+        stats['latency_max'] = max(stats['latency_max'], latency)
+        # Bucket i counts latencies of less than 2**i microseconds
+        bucket = int(max(latency * 1e6, 0)).bit_length()
+        stats['histogram'][min(bucket, LATENCY_BUCKETS - 1)] += 1
+
+    def get_link_stats(self, topic=None):
+        """
+        Get loss and latency statistics for traced topics, per publisher.
+
+        Latencies are only meaningful if the clocks of the publisher and
+        subscriber are synchronized.
+
+        Parameters
+        ----------
+        topic : str, optional
+            Name of topic.  By default, get statistics for all topics.
+
+        Returns
+        -------
+        out : list of dicts
+            One entry per (topic, publisher GUID) with the 'topic', 'guid',
+            number of messages 'received' and 'lost', 'latency_mean' and
+            'latency_max' in seconds, and a latency 'histogram', where entry
+            i counts latencies of less than 2**i microseconds.  Messages that
+            arrive after a later one are counted as 'reordered' instead of
+            'lost'.
+        """
+        out = []
+        for ((stopic, guid), stats) in self._link_stats.items():
+            if topic is not None and stopic != topic:
+                continue
+            link = {}
+            link['topic'] = stopic
+            link['guid'] = uuid.UUID(bytes=guid)
+            link['received'] = stats['received']
+            link['lost'] = stats['lost']
+            link['reordered'] = stats['reordered']
+            link['latency_mean'] = stats['latency_sum'] / stats['received']
+            link['latency_max'] = stats['latency_max']
+            link['histogram'] = list(stats['histogram'])
+            out.append(link)
+        return out
+
+    def _handle_sub_recv(self, frames):
+        """
+        Internal method to dispatch a message received on our SUB socket.
+        """
+        wire_topic = topic = frames[0].bytes.decode('utf-8')
+        rate = None
+        if topic.startswith(RATE_PREFIX):
+            # Only our own connections tell us what a decimated stream is
+            for c in self.sub_connections:
+                if c['wire_topic'] == wire_topic and c['rate'] is not None:
+                    rate, topic = c['rate'], c['topic']
+                    break
+            else:
+                return
+        header = frames[1].bytes
+        mtype = header[:1]
+        subs = [s for s in self._topic_trie.match(topic) if s['rate'] == rate]
+        if not subs:
             return
-        return [addr for (addr, tstamp) in self._listeners[topic].items()
-                if (time.time() - tstamp) < 2 * HB_REPEAT_PERIOD]
+        if mtype == PUB_HB:
+            # A heartbeat on the data connection tells us that it is up, so
+            # we can tell the publisher we're listening.  From then on, the
+            # control channel keeps track of liveness.
+            msg = unpack_msg(frames[2])
+            self._touch_connections('address', msg['address'])
+            for c in self.sub_connections:
+                if (c['wire_topic'] == wire_topic and
+                        c['address'] == msg['address'] and
+                        c['ctl_address'] and not c['synched']):
+                    c['synched'] = True
+                    self._synch(wire_topic, c['ctl_address'])
+        elif mtype == PUB_MSG:
+            # Data is as good a sign of life as a heartbeat
+            if len(header) > 1:
+                self._touch_publisher(wire_topic, header[1:1 + GUID_LENGTH])
+                self._record_trace(topic, header[1:])
+            else:
+                self._touch_publisher(wire_topic)
+            # Only pay for unpacking if somebody wants the decoded message
+            msg = None
+            for s in subs:
+                if s['raw']:
+                    s['cb'](frames)
+                elif s['stream'] is None:
+                    if msg is None:
+                        msg = unwrap_msg(unpack_msg(frames[2]))
+                    self._deliver(s, msg)
+            self.log.debug('Got message: %s' % topic)
+        elif mtype == PUB_STRUCT:
+            type_hash = header[1:1 + TYPE_HASH_LENGTH]
+            if len(header) > 1 + TYPE_HASH_LENGTH:
+                ext = header[1 + TYPE_HASH_LENGTH:]
+                self._touch_publisher(wire_topic, ext[:GUID_LENGTH])
+                self._record_trace(topic, ext)
+            else:
+                self._touch_publisher(wire_topic)
+            for s in subs:
+                if s['raw']:
+                    s['cb'](frames)
+                elif (s['msg_type'] is not None and
+                        s['msg_type'].type_hash == type_hash):
+                    self._deliver(s, s['msg_type'].unpack(frames[2].buffer))
+            self.log.debug('Got message: %s' % topic)
+        elif mtype == PUB_DELTA:
+            self._touch_publisher(wire_topic, header[1:1 + GUID_LENGTH])
+            msg = None
+            if [s for s in subs if not s['raw'] and s['stream'] is None]:
+                msg = self._apply_delta(wire_topic, header, frames[2].buffer)
+            for s in subs:
+                if s['raw']:
+                    s['cb'](frames)
+                elif s['stream'] is None and msg is not None:
+                    self._deliver(s, msg)
+            self.log.debug('Got message: %s' % topic)
+        elif mtype == PUB_CHUNK:
+            chunk = CHUNK_STRUCT.unpack(header[1:1 + CHUNK_STRUCT.size])
+            self._touch_publisher(wire_topic, chunk[0])
+            for s in subs:
+                if s['raw']:
+                    s['cb'](frames)
+                elif s['stream'] is not None:
+                    self._handle_chunk(s, topic, chunk, frames[2].buffer)
+        else:
+            raise ValueError(repr(mtype))
+
+    def _add_timer(self, deadline, period, cb):
+        """
+        Internal method to schedule a timer.
+        """
+        timer = {}
+        timer['cb'] = cb
+        timer['period'] = period
+        timer['deadline'] = deadline
+        timer['cancelled'] = False
+        self._timer_count += 1
+        heapq.heappush(self._timers, (deadline, self._timer_count, timer))
+        return timer
+
+    def create_timer(self, period, cb):
+        """
+        Call a function periodically from the event loop.  The callback
+        should have the signature: cb().
+
+        Parameters
+        ----------
+        period : float
+            Period in seconds.
+        cb : callable
+            Callable that accepts no arguments.
+
+        Returns
+        -------
+        out : dict
+            The timer, which may be passed to cancel_timer().
+        """
+        return self._add_timer(time.time() + period, period, cb)
+
+    def call_later(self, delay, cb):
+        """
+        Call a function once from the event loop after a delay.  The
+        callback should have the signature: cb().
+
+        Parameters
+        ----------
+        delay : float
+            Delay in seconds.
+        cb : callable
+            Callable that accepts no arguments.
+
+        Returns
+        -------
+        out : dict
+            The timer, which may be passed to cancel_timer().
+        """
+        return self._add_timer(time.time() + delay, None, cb)
+
+    def cancel_timer(self, timer):
+        """
+        Cancel a timer created by create_timer() or call_later().
+
+        Parameters
+        ----------
+        timer : dict
+            The timer.
+        """
+        timer['cancelled'] = True
+
+    def _run_timers(self):
+        """
+        Internal method to invoke the timers that are due.
+        """
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if timer['cancelled']:
+                continue
+            if timer['period'] is not None:
+                # Keep to the original schedule, unless we've fallen behind
+                # by more than a period
+                deadline = timer['deadline'] + timer['period']
+                if deadline <= now:
+                    deadline = now + timer['period']
+                timer['deadline'] = deadline
+                self._timer_count += 1
+                heapq.heappush(self._timers,
+                               (deadline, self._timer_count, timer))
+            timer['cb']()
+
+    def _send_heartbeats(self):
+        """
+        Internal method to send our periodic heartbeats.
+        """
+        if self.ctl_socket is not None:
+            self._heartbeat()
+        # Also probe the data connections, for the benefit of new
+        # subscribers
+        for p in self.publishers:
+            msg = pack_msg({'address': p['addresses'][-1]})
+            topics = [p['topic']] + [r['topic'] for r in p['rates'].values()]
+            for topic in topics:
+                try:
+                    p['socket'].send_multipart(
+                        (topic.encode('utf-8'), PUB_HB, msg), zmq.NOBLOCK)
+                except zmq.Again:
+                    pass
+
+    def _send_adverts(self):
+        """
+        Internal method to repeat our advertisements.
+        """
+        [self._advertise(p) for p in self.publishers]
+        [self._advertise_service(srv) for srv in self.services.values()]
 
     def spinOnce(self, timeout=0.001, allow_respin=True):
         """
@@ -593,59 +2605,82 @@ class DZMQ(object):
             Whether to spin again if timeout > 0 with a timeout of 0 to catch
             a follow up message in the queue.  This aids in overall throughput.
         """
+        self._loop_thread = threading.current_thread()
+
+        # Don't sleep past our next timer
+        if self._timers:
+            until_timer = max(self._timers[0][0] - time.time(), 0)
+            if timeout < 0 or timeout > until_timer:
+                timeout = until_timer
+        if self._local_queue:
+            timeout = 0
+
         if timeout < 0:
             # zmq interprets timeout=None as infinite
-            timeout = None
+            poll_timeout = None
         else:
-            # zmq wants the timeout in milliseconds
-            timeout = int(timeout * 1e3)
+            # zmq wants the timeout in milliseconds, and rounding down would
+            # have us spin until a timer is due
+            poll_timeout = int(math.ceil(timeout * 1e3))
 
         # Look for sockets that are ready to read
-        items = dict(self.poller.poll(timeout))
+        items = dict(self.poller.poll(poll_timeout))
+
+        # Deal with the control channel first, so that liveness does not
+        # suffer when the data connections are busy
+        if items.get(self.ctl_socket, None) == zmq.POLLIN:
+            self._handle_ctl_recv()
+        for (ctl_address, sock) in list(self._ctl_sockets.items()):
+            if items.get(sock, None) == zmq.POLLIN:
+                self._handle_ctl_reply(ctl_address, sock)
 
         if items.get(self.bcast_recv.fileno(), None) == zmq.POLLIN:
             self._handle_bcast_recv(self.bcast_recv.recvfrom(UDP_MAX_SIZE))
 
         if items.get(self.sub_socket, None) == zmq.POLLIN:
             # Get the message (assuming that we get it all in one read)
-            topic, mtype, msg = self.sub_socket.recv_multipart()
-            topic = topic.decode('utf-8')
-
-            msg = unpack_msg(msg)
-
-            subs = [s for s in self.subscribers if s['topic'] == topic]
-            if subs:
-                if mtype == PUB_HB:
-                    self._synch(topic, msg['address'])
-                elif mtype == PUB_MSG:
-                    if len(msg) == 1 and '___payload__' in msg:
-                        msg = msg['___payload__']
-                    [s['cb'](msg) for s in subs]
-                    self.log.debug('Got message: %s' % topic)
-                else:
-                    raise ValueError(repr(mtype))
-
-        if (time.time() - self._last_hb_time) > HB_REPEAT_PERIOD:
-            if self.publishers:
-                msg = pack_msg({'address': self.address})
-                for p in self.publishers:
-                    topic = p['topic'].encode('utf-8')
-                    self.pub_socket.send_multipart((topic, PUB_HB, msg))
-            self._last_hb_time = time.time()
-
-        elif (time.time() - self._last_adv_time) > ADV_REPEAT_PERIOD:
-            [self._advertise(p) for p in self.publishers]
-            self._last_adv_time = time.time()
-
-        if timeout > 0 and allow_respin:
+            self._handle_sub_recv(self.sub_socket.recv_multipart(copy=False))
+
+        if items.get(self._collector, None) == zmq.POLLIN:
+            self._handle_thread_queue()
+
+        if self.srv_socket is not None:
+            if items.get(self.srv_socket, None) == zmq.POLLIN:
+                self._handle_srv_request()
+            if items.get(self._srv_reply_socket, None) == zmq.POLLIN:
+                # Forward replies from our worker threads
+                while True:
+                    try:
+                        frames = self._srv_reply_socket.recv_multipart(
+                            zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    self.srv_socket.send_multipart(frames, copy=False)
+
+        # Deliver what we've published to ourselves, but not what that
+        # publishes in turn
+        for i in range(len(self._local_queue)):
+            func, args = self._local_queue.popleft()
+            func(*args)
+
+        for sock in self._peer_sockets.values():
+            if items.get(sock, None) == zmq.POLLIN:
+                self._handle_srv_reply(sock)
+        if self._srv_waiting:
+            self._check_srv_requests()
+
+        self._run_timers()
+
+        if timeout != 0 and allow_respin:
             self.spinOnce(timeout=0)
 
     def spin(self):
         """
-        Give control to the message event loop.
+        Give control to the message event loop.  We wake up for incoming
+        messages and timers only, so an idle node uses next to no CPU.
         """
         while True:
-            self.spinOnce(0.01)
+            self.spinOnce(-1)
 
     def close(self):
         """
@@ -653,8 +2688,22 @@ class DZMQ(object):
         """
         self.bcast_recv.close()
         self.bcast_send.close()
-        self.pub_socket.close()
+        for service in self.services.values():
+            [service['queue'].put(None) for t in service['threads']]
+        [shard['socket'].close() for shard in self._shards.values()]
         self.sub_socket.close()
+        self._collector.close()
+        self._doorbell.close()
+        if self.srv_socket is not None:
+            self.srv_socket.close()
+        if self._srv_reply_socket is not None:
+            self._srv_reply_socket.close()
+        [sock.close() for sock in self._peer_sockets.values()]
+        if self.ctl_socket is not None:
+            self.ctl_socket.close()
+        [sock.close() for sock in self._ctl_sockets.values()]
+        if self._own_context:
+            self.context.term()
 
 # Stolen from rosgraph
 # https://github.com/ros/ros_comm/blob/hydro-devel/tools/rosgraph/src/rosgraph/network.py
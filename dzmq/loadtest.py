@@ -0,0 +1,299 @@
+"""
+Multi-process discovery and throughput load test.
+
+Starts a number of node processes on this machine, each advertising and
+subscribing to a set of topics, and measures how long it takes for every
+publisher to see all of its listeners, how much discovery traffic that takes,
+the CPU used by each node, and the message rates sustained afterwards.  A
+private broadcast port is used, so that the test does not disturb (or get
+disturbed by) other nodes on the network.
+
+Usage: dzmq-loadtest --nodes 100 --topics 50 --subs 5 --rate 100
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .core import DZMQ, DZMQ_PORT_KEY
+from .utils import get_log
+
+
+class CountingDZMQ(DZMQ):
+
+    """
+    DZMQ interface that counts the discovery packets it receives.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.bcast_count = 0
+        super(CountingDZMQ, self).__init__(*args, **kwargs)
+
+    def _handle_bcast_recv(self, msg):
+        self.bcast_count += 1
+        super(CountingDZMQ, self)._handle_bcast_recv(msg)
+
+
+def make_plan(nodes, topics, subs, seed=0):
+    """
+    Decide which node publishes and subscribes to which topics.
+
+    Topics are published by one node each, round robin.  Each node
+    subscribes to a random selection of the topics it does not publish.
+
+    Parameters
+    ----------
+    nodes : int
+        Number of nodes.
+    topics : int
+        Number of topics.
+    subs : int
+        Number of topics each node subscribes to.
+    seed : int, optional
+        Random seed.
+
+    Returns
+    -------
+    out : list of dicts
+        Per node 'pubs' and 'subs' topic lists, and the 'listeners' expected
+        for each topic it publishes.
+    """
+    rand = random.Random(seed)
+    names = ['loadtest/%d' % i for i in range(topics)]
+    plan = [{'pubs': [], 'subs': [], 'listeners': {}} for i in range(nodes)]
+    for (i, name) in enumerate(names):
+        plan[i % nodes]['pubs'].append(name)
+    for node in plan:
+        others = [name for name in names if name not in node['pubs']]
+        node['subs'] = rand.sample(others, min(subs, len(others)))
+    for node in plan:
+        for name in node['pubs']:
+            node['listeners'][name] = len([n for n in plan
+                                           if name in n['subs']])
+    return plan
+
+
+def _cpu_time():
+    """
+    Get the CPU time used by this process so far, in seconds.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run_node(index, node, options, results, go):
+    """
+    Run one node of the load test.  Results are put on the results queue.
+    """
+    if options['ipc_dir']:
+        address = 'ipc://%s/node-%d' % (options['ipc_dir'], index)
+    else:
+        address = None
+    d = CountingDZMQ(address=address)
+    received = [0]
+
+    def cb(msg):
+        received[0] += 1
+
+    tstart = time.time()
+    cpu_start = _cpu_time()
+    [d.advertise(name) for name in node['pubs']]
+    [d.subscribe(name, cb) for name in node['subs']]
+
+    # Phase 1: wait for our listeners, but keep serving everybody else until
+    # all of the nodes are connected
+    connected = None
+    while not go.is_set():
+        d.spinOnce(0.01)
+        if connected is None and all(
+                len(d.get_listeners(name) or []) >= count
+                for (name, count) in node['listeners'].items()):
+            connected = time.time() - tstart
+            results.put(('connected', index, connected))
+    tconnect = time.time() - tstart
+    discovery = d.bcast_count
+    cpu_connect = _cpu_time() - cpu_start
+
+    # Phase 2: publish at a steady rate
+    payload = 'x' * options['size']
+    sent = [0]
+
+    def publish():
+        for name in node['pubs']:
+            sent[0] += d.publish(name, payload)
+
+    if node['pubs'] and options['rate']:
+        d.create_timer(1.0 / options['rate'], publish)
+    received[0] = 0
+    cpu_start = _cpu_time()
+    tstart = time.time()
+    while time.time() - tstart < options['duration']:
+        d.spinOnce(0.01)
+    elapsed = time.time() - tstart
+
+    stats = {}
+    stats['connected'] = connected
+    stats['discovery_rate'] = discovery / tconnect
+    stats['cpu_connect'] = cpu_connect / tconnect
+    stats['cpu_steady'] = (_cpu_time() - cpu_start) / elapsed
+    stats['sent_rate'] = sent[0] / elapsed
+    stats['received_rate'] = received[0] / elapsed
+    results.put(('done', index, stats))
+    d.close()
+
+
+def run(nodes=10, topics=10, subs=3, rate=100, size=100, duration=5.0,
+        connect_timeout=60.0, port=None, ipc=True):
+    """
+    Run a load test.
+
+    Parameters
+    ----------
+    nodes : int, optional
+        Number of node processes.
+    topics : int, optional
+        Number of topics.
+    subs : int, optional
+        Number of topics each node subscribes to.
+    rate : float, optional
+        Messages per second sent on each topic once connected.
+    size : int, optional
+        Message payload size in bytes.
+    duration : float, optional
+        Seconds to send messages for.
+    connect_timeout : float, optional
+        Seconds to wait for all nodes to be connected.
+    port : int, optional
+        Broadcast port.  By default, pick a random one.
+    ipc : bool, optional
+        Whether to use ipc:// rather than tcp:// data connections.
+
+    Returns
+    -------
+    out : list of dicts
+        Per node results: the time taken to see all listeners in seconds
+        ('connected', None if it never did), discovery packets received per
+        second while connecting ('discovery_rate'), the fraction of a core
+        used while connecting and while sending ('cpu_connect' and
+        'cpu_steady'), and the messages per second sent and received
+        ('sent_rate' and 'received_rate').
+    """
+    log = get_log('loadtest')
+    plan = make_plan(nodes, topics, subs)
+    options = {}
+    options['rate'] = rate
+    options['size'] = size
+    options['duration'] = duration
+    options['ipc_dir'] = tempfile.mkdtemp(prefix='dzmq-') if ipc else None
+
+    # Children inherit our environment
+    old_port = os.environ.get(DZMQ_PORT_KEY)
+    os.environ[DZMQ_PORT_KEY] = str(port or random.randint(20000, 30000))
+
+    results = multiprocessing.Queue()
+    go = multiprocessing.Event()
+    procs = [multiprocessing.Process(target=run_node,
+                                     args=(i, node, options, results, go))
+             for (i, node) in enumerate(plan)]
+    try:
+        [p.start() for p in procs]
+        connected = 0
+        tstart = time.time()
+        while (connected < nodes and
+               time.time() - tstart < connect_timeout):
+            try:
+                kind, index, value = results.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            connected += 1
+        if connected < nodes:
+            log.warn('Warning: only %d of %d nodes connected' %
+                     (connected, nodes))
+        go.set()
+
+        out = [None] * nodes
+        for i in range(nodes):
+            kind, index, value = results.get(timeout=duration +
+                                             connect_timeout)
+            while kind != 'done':
+                kind, index, value = results.get(timeout=duration +
+                                                 connect_timeout)
+            out[index] = value
+        [p.join() for p in procs]
+    finally:
+        [p.terminate() for p in procs if p.is_alive()]
+        if options['ipc_dir']:
+            shutil.rmtree(options['ipc_dir'], ignore_errors=True)
+        if old_port is None:
+            del os.environ[DZMQ_PORT_KEY]
+        else:
+            os.environ[DZMQ_PORT_KEY] = old_port
+    return out
+
+
+def _summary(name, values, fmt):
+    values = [v for v in values if v is not None]
+    if not values:
+        return '%-24s n/a' % name
+    values.sort()
+    return ('%-24s mean ' + fmt + '  max ' + fmt) % (
+        name, sum(values) / len(values), values[-1])
+
+
+def main(argv=None):
+    """
+    Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--topics', type=int, default=10)
+    parser.add_argument('--subs', type=int, default=3,
+                        help='topics subscribed to by each node')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='messages per second per topic')
+    parser.add_argument('--size', type=int, default=100,
+                        help='message payload size in bytes')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds to send messages for')
+    parser.add_argument('--connect-timeout', type=float, default=60.0)
+    parser.add_argument('--port', type=int, default=None,
+                        help='broadcast port (random by default)')
+    parser.add_argument('--tcp', action='store_true',
+                        help='use tcp:// instead of ipc:// connections')
+    args = parser.parse_args(argv)
+
+    results = run(nodes=args.nodes, topics=args.topics, subs=args.subs,
+                  rate=args.rate, size=args.size, duration=args.duration,
+                  connect_timeout=args.connect_timeout, port=args.port,
+                  ipc=not args.tcp)
+
+    connected = [r['connected'] for r in results]
+    print('%d of %d nodes saw all their listeners' % (
+        len([c for c in connected if c is not None]), len(results)))
+    print(_summary('time to connect (s)', connected, '%8.3f'))
+    print(_summary('discovery (packets/s)',
+                   [r['discovery_rate'] for r in results], '%8.1f'))
+    print(_summary('cpu connecting (cores)',
+                   [r['cpu_connect'] for r in results], '%8.3f'))
+    print(_summary('cpu sending (cores)',
+                   [r['cpu_steady'] for r in results], '%8.3f'))
+    print(_summary('sent (msgs/s)',
+                   [r['sent_rate'] for r in results], '%8.1f'))
+    print(_summary('received (msgs/s)',
+                   [r['received_rate'] for r in results], '%8.1f'))
+    print('total received: %.1f msgs/s' %
+          sum(r['received_rate'] for r in results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
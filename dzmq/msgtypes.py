@@ -0,0 +1,183 @@
+import hashlib
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Map of scalar type names to struct codes
+SCALAR_TYPES = {
+    'bool': '?',
+    'int8': 'b',
+    'uint8': 'B',
+    'int16': 'h',
+    'uint16': 'H',
+    'int32': 'i',
+    'uint32': 'I',
+    'int64': 'q',
+    'uint64': 'Q',
+    'float32': 'f',
+    'float64': 'd',
+}
+
+TYPE_HASH_LENGTH = 8
+
+
+def parse_msg_def(text):
+    """
+    Parse a message definition in the style of a ROS msg file.
+
+    Each line holds a type and a field name, e.g. 'float64 stamp' or
+    'float32[3] accel' for a fixed size array.  Comments start with '#'.
+
+    Parameters
+    ----------
+    text : str
+        Message definition.
+
+    Returns
+    -------
+    out : list of tuples
+        Fields as (name, type, count) tuples.
+    """
+    fields = []
+    for line in text.splitlines():
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        ftype, name = line.split()
+        count = 1
+        if ftype.endswith(']'):
+            ftype, count = ftype[:-1].split('[')
+            count = int(count)
+        fields.append((name, ftype, count))
+    return fields
+
+
+class MessageType(object):
+
+    """
+    A fixed layout message type, which packs to and from bytes with a single
+    struct call instead of walking a dictionary.
+
+    msg_type = MessageType('Imu', [('stamp', 'float64'),
+                                   ('accel', 'float32', 3)])
+    data = msg_type.pack({'stamp': 1.0, 'accel': [0.0, 0.0, 9.8]})
+    msg = msg_type.unpack(data)
+
+    """
+
+    def __init__(self, name, fields):
+        """ Initialize the message type
+
+        Parameters
+        ----------
+        name : str
+            Type name.
+        fields : str or list of tuples
+            Message definition (see parse_msg_def), or a list of
+            (name, type) or (name, type, count) tuples, where count is the
+            size of a fixed size array.
+        """
+        if not isinstance(fields, list):
+            fields = parse_msg_def(fields)
+        self.name = name
+        self.fields = []
+        fmt = '<'
+        for field in fields:
+            fname, ftype = field[:2]
+            count = field[2] if len(field) > 2 else 1
+            if ftype not in SCALAR_TYPES:
+                raise ValueError('Unknown type %s for field %s'
+                                 % (ftype, fname))
+            self.fields.append((fname, ftype, count))
+            fmt += '%d%s' % (count, SCALAR_TYPES[ftype])
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+        # The hash covers the layout, so that publishers and subscribers
+        # can check that they agree on it.
+        definition = '\n'.join('%s %s %d' % f for f in self.fields)
+        definition = '%s\n%s' % (name, definition)
+        self.type_hash = hashlib.sha1(
+            definition.encode('utf-8')).digest()[:TYPE_HASH_LENGTH]
+
+        if np:
+            self.dtype = np.dtype([(fname, '<' + SCALAR_TYPES[ftype],
+                                    (count,) if count > 1 else ())
+                                   for (fname, ftype, count) in self.fields])
+        else:
+            self.dtype = None
+        self._arrays = any(count > 1 for (_, _, count) in self.fields)
+
+    def pack(self, msg):
+        """
+        Pack a message into bytes.
+
+        Parameters
+        ----------
+        msg : dict
+            Message with a value for every field.
+
+        Returns
+        -------
+        out : bytes
+            Packed message.
+        """
+        if not self._arrays:
+            return self.struct.pack(*[msg[fname]
+                                      for (fname, _, _) in self.fields])
+        values = []
+        for (fname, ftype, count) in self.fields:
+            if count > 1:
+                values.extend(msg[fname])
+            else:
+                values.append(msg[fname])
+        return self.struct.pack(*values)
+
+    def unpack(self, data):
+        """
+        Unpack bytes into a message.
+
+        Parameters
+        ----------
+        data : bytes or buffer
+            Packed message.
+
+        Returns
+        -------
+        out : dict
+            Message, where fixed size arrays are given as lists.
+        """
+        values = self.struct.unpack(data)
+        if not self._arrays:
+            return dict(zip([f[0] for f in self.fields], values))
+        msg = {}
+        offset = 0
+        for (fname, ftype, count) in self.fields:
+            if count > 1:
+                msg[fname] = list(values[offset:offset + count])
+            else:
+                msg[fname] = values[offset]
+            offset += count
+        return msg
+
+    def frombuffer(self, data):
+        """
+        View bytes as a NumPy structured record, without copying.
+
+        Parameters
+        ----------
+        data : bytes or buffer
+            Packed message.
+
+        Returns
+        -------
+        out : numpy.void
+            Record with one entry per field.
+        """
+        if self.dtype is None:
+            raise ImportError('NumPy is required for frombuffer')
+        return np.frombuffer(data, dtype=self.dtype, count=1)[0]
@@ -1,6 +1,13 @@
-from dzmq import DZMQ
+from dzmq import DZMQ, MessageType, ServiceError
+from dzmq import core
+from dzmq.core import HB_REPEAT_PERIOD, PEER_TIMEOUT, SRV_EXPIRE_PERIOD
 
 import logging
+import os
+import tempfile
+import threading
+import time
+import zmq
 try:
     from StringIO import StringIO
 except ImportError:
@@ -11,6 +18,17 @@ except ImportError:
     np = None
 
 
+def spin_until(cond, nodes, timeout=10.0):
+    """
+    Spin the given nodes until a condition holds, failing the test rather
+    than hanging if it does not in time.
+    """
+    deadline = time.time() + timeout
+    while not cond():
+        assert time.time() < deadline, 'Timed out'
+        [node.spinOnce() for node in nodes]
+
+
 class TestPubSub(object):
 
     def setup(self):
@@ -31,9 +49,7 @@ class TestPubSub(object):
         return output
 
     def synch(self, topic):
-        while not self.pub.get_listeners(topic):
-            self.sub.spinOnce()
-            self.pub.spinOnce()
+        spin_until(lambda: self.pub.get_listeners(topic), [self.sub, self.pub])
 
     def test_basic(self):
         self.pub.advertise('what_what')
@@ -124,6 +140,22 @@ class TestPubSub(object):
         assert "Connected to" in output
         assert "Got message: yeah_yeah" not in output
 
+    def test_advert_size(self):
+        # The longest topic fits
+        self.pub.advertise('x' * core.TOPIC_MAXLENGTH)
+
+        max_size = core.UDP_MAX_SIZE
+        core.UDP_MAX_SIZE = 100
+        try:
+            self.pub.advertise('y' * 100)
+        except Exception as e:
+            assert 'exceeds maximum' in str(e), e
+        else:
+            assert False, 'Expected an exception'
+        finally:
+            core.UDP_MAX_SIZE = max_size
+        assert not [p for p in self.pub.publishers if p['topic'][0] == 'y']
+
     def test_unsubscribe(self):
         self.pub.advertise('yeah_yeah')
         payload = {'spam': 100}
@@ -153,6 +185,648 @@ class TestPubSub(object):
         output = self.get_log()
         assert "Got message: yeah_yeah" not in output, output
 
+    def test_unsubscribe_disconnects(self):
+        self.pub.advertise('yeah_yeah')
+        self.sub.subscribe('yeah_yeah', lambda msg: None)
+        self.sub.subscribe('yeah_*', lambda msg: None)
+        self.synch('yeah_yeah')
+
+        # The remaining pattern still wants the topic
+        self.sub.unsubscribe('yeah_yeah')
+        assert len(self.sub.sub_connections) == 1
+
+        self.sub.unsubscribe('yeah_*')
+        assert self.sub.sub_connections == []
+        assert "Disconnected from" in self.get_log()
+
+        # The publisher hears about it before the listener would time out
+        tstart = time.time()
+        spin_until(lambda: not self.pub.get_listeners('yeah_yeah'), [self.pub])
+        assert time.time() - tstart < HB_REPEAT_PERIOD
+
+        self.pub.publish('yeah_yeah', 'spam')
+        assert not self.sub.sub_socket.poll(100)
+
+    def test_unadvertise_disconnects(self):
+        self.pub.advertise('yeah_yeah')
+        self.pub.subscribe('yeah_yeah', lambda msg: None)
+        self.sub.subscribe('yeah_yeah', lambda msg: None)
+        self.synch('yeah_yeah')
+
+        self.pub.unadvertise('yeah_yeah')
+        spin_until(lambda: not (self.sub.sub_connections or
+                                self.pub.sub_connections),
+                   [self.sub, self.pub])
+
+        # We can advertise it again
+        self.pub.advertise('yeah_yeah')
+        self.synch('yeah_yeah')
+
+    def test_peer_expiry(self):
+        self.pub.advertise('yeah_yeah')
+        self.sub.subscribe('yeah_yeah', lambda msg: None)
+        self.synch('yeah_yeah')
+        assert self.pub.guid in self.sub._peers
+        joined = self.sub.get_peer_stats()['joined']
+
+        # Pretend the publisher died a while ago
+        self.pub.close()
+        self.sub._peers[self.pub.guid]['last_seen'] -= 10
+        self.sub._expire_peers()
+        assert self.pub.guid not in self.sub._peers
+        assert self.sub.sub_connections == []
+        stats = self.sub.get_peer_stats()
+        assert stats['expired'] == 1, stats
+        assert stats['joined'] == joined, stats
+
+    def test_data_keeps_peer_alive(self):
+        self.pub.advertise('yeah_yeah')
+        self.sub.subscribe('yeah_yeah', lambda msg: None)
+        self.synch('yeah_yeah')
+
+        self.pub.publish('yeah_yeah', 'spam')
+        frames = None
+        while frames is None or frames[1].bytes[:1] != core.PUB_MSG:
+            assert self.sub.sub_socket.poll(1000), 'Timed out'
+            frames = self.sub.sub_socket.recv_multipart(copy=False)
+
+        # A message shows the publisher is alive even if its ADVs are lost
+        self.sub._peers[self.pub.guid]['last_seen'] -= 10
+        self.sub._handle_sub_recv(frames)
+        self.sub._expire_peers()
+        assert self.pub.guid in self.sub._peers
+        assert len(self.sub.sub_connections) == 1
+
+    def test_peer_restart(self):
+        address = 'ipc://%s/pub' % tempfile.mkdtemp()
+        self.pub.close()
+        self.pub = DZMQ(address=address)
+        self.pub.advertise('yeah_yeah')
+        self.sub.subscribe('yeah_yeah', lambda msg: None)
+        self.synch('yeah_yeah')
+
+        # A new process takes over the address
+        old_guid = self.pub.guid
+        self.pub.close()
+        self.pub = DZMQ(address=address)
+        self.pub.advertise('yeah_yeah')
+        self.synch('yeah_yeah')
+        assert [c['guid'] for c in self.sub.sub_connections] == [
+            self.pub.guid]
+        assert old_guid not in self.sub._peers
+        assert self.sub.get_peer_stats()['restarted'] == 1
+
+    def test_local(self):
+        self.pub.advertise('local')
+        received = []
+        copies = []
+
+        self.pub.subscribe('local', received.append, queued=False)
+        self.pub.subscribe('local', copies.append, copy=True)
+
+        # Nobody else is listening, so this is never serialized
+        payload = {'obj': object()}
+        assert self.pub.publish('local', payload)
+        assert received[0]['obj'] is payload['obj']
+        assert not copies
+        self.pub.spinOnce(0)
+        assert copies[0]['obj'] is not payload['obj']
+
+        if np:
+            payload = {'data': np.arange(10)}
+            self.pub.publish('local', payload)
+            self.pub.spinOnce(0)
+            assert np.shares_memory(received[1]['data'], payload['data'])
+            assert not received[1]['data'].flags.writeable
+            assert not np.shares_memory(copies[1]['data'], payload['data'])
+
+    def test_local_and_remote(self):
+        self.pub.advertise('both')
+        local = []
+        remote = []
+
+        self.pub.subscribe('both', local.append)
+        self.sub.subscribe('both', remote.append)
+        self.synch('both')
+        self.pub.publish('both', 'spam')
+        spin_until(lambda: local and remote, [self.pub, self.sub])
+
+        assert local == ['spam'] and remote == ['spam']
+
+        if np:
+            # Packing the message for the remote subscriber leaves it alone
+            # for the local one
+            payload = {'a': np.arange(4), 'b': {'c': np.ones(2)}}
+            self.pub.publish('both', payload)
+            spin_until(lambda: len(local) >= 2 and len(remote) >= 2,
+                       [self.pub, self.sub])
+            assert isinstance(payload['a'], np.ndarray)
+            assert isinstance(payload['b']['c'], np.ndarray)
+            assert np.shares_memory(local[1]['a'], payload['a'])
+            assert np.shares_memory(local[1]['b']['c'], payload['b']['c'])
+            assert np.array_equal(remote[1]['a'], payload['a'])
+            assert np.array_equal(remote[1]['b']['c'], payload['b']['c'])
+
+    def test_threads(self):
+        self.pub.advertise('threads')
+        local = []
+        remote = []
+
+        self.pub.subscribe('threads', local.append)
+        self.sub.subscribe('threads', remote.append)
+        self.synch('threads')
+
+        def produce(i):
+            for j in range(100):
+                assert self.pub.publish('threads', [i, j])
+
+        threads = [threading.Thread(target=produce, args=(i,))
+                   for i in range(4)]
+        [t.start() for t in threads]
+        spin_until(lambda: len(local) >= 400 and len(remote) >= 400,
+                   [self.pub, self.sub])
+        [t.join() for t in threads]
+
+        for i in range(4):
+            assert [m for m in local if m[0] == i] == [[i, j] for j in
+                                                       range(100)]
+        assert sorted(remote) == sorted(local)
+
+        if np:
+            # The message packed on the producer thread is left alone for
+            # the local subscriber
+            payload = {'a': np.arange(4)}
+            thread = threading.Thread(target=self.pub.publish,
+                                      args=('threads', payload))
+            thread.start()
+            thread.join()
+            spin_until(lambda: len(local) >= 401 and len(remote) >= 401,
+                       [self.pub, self.sub])
+            assert isinstance(payload['a'], np.ndarray)
+            assert np.shares_memory(local[-1]['a'], payload['a'])
+            assert np.array_equal(remote[-1]['a'], payload['a'])
+
+    def test_max_rate(self):
+        self.pub.advertise('fast')
+        full = []
+        slow = []
+        local = []
+
+        self.sub.subscribe('fast', full.append)
+        self.sub.subscribe('fast', slow.append, max_rate=10)
+        self.pub.subscribe('fast', local.append, max_rate=10)
+        spin_until(lambda: len(self.pub.get_listeners('fast') or []) >= 2,
+                   [self.sub, self.pub])
+
+        tstart = time.time()
+        for i in range(100):
+            self.pub.publish('fast', i)
+            while time.time() - tstart < (i + 1) * 0.005:
+                self.sub.spinOnce(0)
+                self.pub.spinOnce(0)
+        spin_until(lambda: len(full) >= 100, [self.sub])
+
+        assert full == list(range(100))
+        assert 4 <= len(slow) <= 6, slow
+        assert slow[0] == 0 and slow == sorted(slow)
+        assert 4 <= len(local) <= 6, local
+
+        try:
+            self.sub.subscribe('fast', slow.append, max_rate=0)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected a ValueError'
+
+        # Topics that look like decimated streams are reserved
+        for f in (self.pub.advertise,
+                  lambda topic: self.sub.subscribe(topic, slow.append)):
+            try:
+                f('@10:fast')
+            except ValueError:
+                pass
+            else:
+                assert False, 'Expected a ValueError'
+        self.sub._handle_sub_recv([zmq.Frame(b'@a:b'),
+                                   zmq.Frame(core.PUB_MSG), zmq.Frame(b'')])
+
+        # The rate is no longer served once its listeners are gone
+        self.sub.unsubscribe('fast')
+        spin_until(lambda: not self.pub.get_listeners('fast'),
+                   [self.sub, self.pub])
+        for rate in self.pub.publishers[0]['rates'].values():
+            rate['tstamp'] -= PEER_TIMEOUT
+        self.pub._heartbeat()
+        assert not self.pub.publishers[0]['rates']
+
+    def test_wildcard(self):
+        self.pub.advertise('sensors/imu')
+        self.pub.advertise('sensors/cam')
+        self.pub.advertise('status')
+        topics = []
+
+        self.sub.subscribe('sensors/*', lambda msg: topics.append(msg))
+        self.sub.subscribe('sens', lambda msg: topics.append(msg),
+                           prefix=True)
+
+        self.synch('sensors/imu')
+        self.synch('sensors/cam')
+        self.pub.publish('status', 'status')
+        self.pub.publish('sensors/imu', 'imu')
+        self.pub.publish('sensors/cam', 'cam')
+        spin_until(lambda: len(topics) >= 4, [self.sub])
+
+        assert topics == ['imu', 'imu', 'cam', 'cam'], topics
+
+    def test_shards(self):
+        self.pub.close()
+        self.pub = DZMQ(pub_shards=4, io_threads=2)
+        self.pub.advertise('camera', shard='camera',
+                           socket_options={zmq.SNDHWM: 10})
+        self.pub.advertise('control')
+        camera = [p for p in self.pub.publishers if p['topic'] == 'camera']
+        control = [p for p in self.pub.publishers if p['topic'] == 'control']
+        assert camera[0]['socket'] is not control[0]['socket']
+        assert camera[0]['socket'].getsockopt(zmq.SNDHWM) == 10
+        received = []
+
+        self.sub.subscribe('camera', received.append)
+        self.sub.subscribe('control', received.append)
+
+        self.synch('camera')
+        self.synch('control')
+        self.pub.publish('camera', 'frame')
+        self.pub.publish('control', 'stop')
+        spin_until(lambda: len(received) >= 2, [self.sub])
+
+        assert sorted(received) == ['frame', 'stop'], received
+
+    def test_raw_forward(self):
+        self.pub.advertise('raw', trace=True)
+        self.sub.advertise('relay', trace=True)
+        payload = {'spam': 100}
+        frames = []
+        relayed = []
+        slow = []
+
+        def cb(msg):
+            frames.append(msg)
+            self.sub.forward(msg, 'relay')
+
+        self.sub.subscribe('raw', cb, raw=True)
+        self.pub.subscribe('relay', relayed.append)
+        self.pub.subscribe('relay', slow.append, max_rate=10)
+
+        self.synch('raw')
+        spin_until(lambda: len(self.sub.get_listeners('relay') or []) >= 2,
+                   [self.pub, self.sub])
+        self.pub.publish('raw', payload)
+        spin_until(lambda: relayed and slow, [self.sub, self.pub])
+
+        assert isinstance(frames[0][2], zmq.Frame)
+        assert relayed == [payload], relayed
+        assert slow == [payload], slow
+        # The relay traces its own link
+        stats = self.pub.get_link_stats('relay')
+        assert [s['guid'] for s in stats] == [self.sub.guid], stats
+        assert stats[0]['received'] == 1 and stats[0]['lost'] == 0, stats
+
+    def test_msg_type(self):
+        imu = MessageType('Imu', [('stamp', 'float64'),
+                                  ('accel', 'float32', 3)])
+        other = MessageType('Imu', [('stamp', 'float32')])
+        self.pub.advertise('imu', msg_type=imu)
+        payload = {'stamp': 2.0, 'accel': [1.0, 2.0, 3.0]}
+        received = []
+
+        self.sub.subscribe('imu', received.append, msg_type=imu)
+        self.synch('imu')
+        self.pub.publish('imu', payload)
+        spin_until(lambda: received, [self.sub])
+        assert received == [payload], received
+
+        # A mismatched type is refused at discovery
+        self.pub.advertise('imu2', msg_type=imu)
+        self.sub.subscribe('imu2', received.append, msg_type=other)
+        for i in range(10):
+            self.pub.spinOnce()
+            self.sub.spinOnce()
+        output = self.get_log()
+        assert 'Connected to' in output
+        assert 'mismatched message type' in output
+        assert not [c for c in self.sub.sub_connections
+                    if c['topic'] == 'imu2']
+
+        # So is a subscriber without a type, which could not decode them
+        self.pub.advertise('imu3', msg_type=imu)
+        self.sub.subscribe('imu3', received.append)
+        for i in range(10):
+            self.pub.spinOnce()
+            self.sub.spinOnce()
+        assert 'ignoring imu3 due to mismatched' in self.get_log()
+        assert not [c for c in self.sub.sub_connections
+                    if c['topic'] == 'imu3']
+        assert not self.pub.get_listeners('imu3')
+
+    def test_batch(self):
+        self.pub.advertise('batch')
+        batches = []
+
+        self.sub.subscribe_batch('batch', batches.append, max_batch=3,
+                                 max_latency=0.05)
+        self.synch('batch')
+        for i in range(4):
+            self.pub.publish('batch', i)
+        spin_until(lambda: sum(len(b) for b in batches) >= 4, [self.sub])
+
+        assert batches == [[0, 1, 2], [3]], batches
+
+        # A pending batch is delivered on unsubscribe
+        self.pub.advertise('batch2')
+        self.sub.subscribe_batch('batch2', batches.append, max_latency=10)
+        self.synch('batch2')
+        self.pub.publish('batch2', 4)
+        spin_until(lambda: self.sub.subscribers[-1]['batch']['count'],
+                   [self.sub])
+        self.sub.unsubscribe('batch2')
+        assert batches[-1] == [4], batches
+
+    def test_batch_arrays(self):
+        if not np:
+            return
+        self.pub.advertise('arrays')
+        batches = []
+
+        self.sub.subscribe_batch('arrays', lambda b: batches.append(b.copy()),
+                                 max_batch=2)
+        self.synch('arrays')
+        for i in range(2):
+            self.pub.publish('arrays', np.ones((2, 3)) * i)
+        spin_until(lambda: batches, [self.sub])
+
+        assert batches[0].shape == (2, 2, 3), batches
+        assert batches[0][1].sum() == 6
+
+    def test_stream(self):
+        self.pub.advertise('stream')
+        streams = []
+        chunks = []
+
+        self.sub.subscribe_stream('stream', streams.append,
+                                  chunk_cb=lambda *args: chunks.append(args))
+        self.synch('stream')
+        payload = os.urandom(3 * 65536 + 10)
+        with tempfile.TemporaryFile() as fid:
+            fid.write(payload)
+            fid.flush()
+            stream_id = self.pub.publish_stream('stream', fid,
+                                                chunk_size=65536)
+            spin_until(lambda: streams, [self.pub, self.sub])
+
+        assert streams == [payload]
+        assert [c[0] for c in chunks] == [stream_id] * 4
+        assert [c[1] for c in chunks] == [0, 1, 2, 3]
+        assert [c[3] for c in chunks] == [False, False, False, True]
+
+        self.pub.publish_stream('stream', (b'abc' for i in range(3)))
+        spin_until(lambda: len(streams) >= 2, [self.pub, self.sub])
+        assert streams[1] == b'abcabcabc'
+
+    def test_stream_max_size(self):
+        self.pub.advertise('stream')
+        streams = []
+
+        self.sub.subscribe_stream('stream', streams.append, max_size=10)
+        self.synch('stream')
+        self.pub.publish_stream('stream', b'x' * 20, chunk_size=4)
+        self.pub.publish_stream('stream', b'y' * 10, chunk_size=4)
+        spin_until(lambda: streams, [self.pub, self.sub])
+
+        assert streams == [b'y' * 10], streams
+        assert 'size exceeds 10 bytes' in self.get_log()
+
+    def test_delta(self):
+        if not np:
+            return
+        from dzmq.core import DELTA_KEY, DELTA_SPARSE, DELTA_XOR
+        self.pub.advertise('grid', delta=True, keyframe_interval=4)
+        received = []
+        kinds = []
+
+        self.sub.subscribe('grid', received.append)
+        self.sub.subscribe('grid', lambda frames: kinds.append(
+            core.DELTA_STRUCT.unpack_from(frames[1].bytes, 1)[2]), raw=True)
+        self.synch('grid')
+
+        grid = np.zeros((100, 100))
+        sent = []
+        for i in range(6):
+            grid[i, :10] = i + 1
+            if i == 2:
+                # Change most of the array, in a compressible way
+                grid[:90] += 1
+            self.pub.publish('grid', grid)
+            sent.append(grid.copy())
+        spin_until(lambda: len(kinds) >= 6, [self.sub])
+
+        assert kinds == [DELTA_KEY, DELTA_SPARSE, DELTA_XOR, DELTA_SPARSE,
+                         DELTA_SPARSE, DELTA_KEY], kinds
+        assert len(received) == 6
+        for (expected, msg) in zip(sent, received):
+            assert np.array_equal(expected, msg)
+
+        # A subscriber that missed a message waits for the next keyframe
+        self.sub._delta_state.clear()
+        for i in range(5):
+            grid[0, i] = -1
+            self.pub.publish('grid', grid)
+        spin_until(lambda: len(kinds) >= 11, [self.sub])
+        assert len(received) == 7, len(received)
+        assert np.array_equal(received[-1], grid)
+
+    def test_trace(self):
+        self.pub.advertise('traced', trace=True)
+        received = []
+
+        self.sub.subscribe('traced', received.append)
+        self.synch('traced')
+        self.pub.publish('traced', 'first')
+        # Pretend a message was dropped on the way
+        self.pub.publishers[0]['seq'] += 1
+        self.pub.publish('traced', 'third')
+        spin_until(lambda: len(received) >= 2, [self.sub])
+
+        assert received == ['first', 'third'], received
+        stats = self.sub.get_link_stats('traced')
+        assert len(stats) == 1, stats
+        assert stats[0]['guid'] == self.pub.guid
+        assert stats[0]['received'] == 2
+        assert stats[0]['lost'] == 1
+        assert sum(stats[0]['histogram']) == 2
+        assert stats[0]['latency_max'] >= 0
+
+    def test_rate_limit(self):
+        self.pub.advertise('limited', rate=10, burst=2)
+
+        sent = [self.pub.publish('limited', i) for i in range(5)]
+        assert sent == [True, True, False, False, False], sent
+        stats = self.pub.get_publish_stats('limited')
+        assert stats['sent'] == 2 and stats['dropped'] == 3, stats
+
+    def test_backpressure(self):
+        self.pub.close()
+        self.pub = DZMQ(socket_options={zmq.SNDHWM: 1})
+        self.pub.advertise('bulk', rate=1e6, adaptive=True)
+        self.sub.sub_socket.setsockopt(zmq.RCVHWM, 1)
+        self.sub.subscribe('bulk', lambda msg: None)
+        self.synch('bulk')
+
+        # Nobody is reading, so the queue fills up
+        payload = 'x' * 1000000
+        sent = [self.pub.publish('bulk', payload) for i in range(200)]
+        assert True in sent
+        assert False in sent
+        stats = self.pub.get_publish_stats('bulk')
+        assert stats['dropped'] == sent.count(False), stats
+        assert stats['rate'] < 1e6, stats
+
+    def test_slow_subscriber(self):
+        self.pub.close()
+        self.pub = DZMQ(socket_options={zmq.SNDHWM: 5})
+        self.pub.advertise('fanout')
+        slow = DZMQ()
+        try:
+            slow.sub_socket.setsockopt(zmq.RCVHWM, 1)
+            slow.subscribe('fanout', lambda msg: None)
+            received = []
+            self.sub.subscribe('fanout', received.append)
+            spin_until(
+                lambda: len(self.pub.get_listeners('fanout') or []) >= 2,
+                [slow, self.sub, self.pub])
+
+            # One subscriber stops reading, which must not hold up the other
+            payload = 'x' * 100000
+            for i in range(300):
+                assert self.pub.publish('fanout', payload)
+                # Keep the publisher spinning, or it would look dead
+                spin_until(lambda: len(received) >= i + 1,
+                           [self.sub, self.pub])
+            stats = self.pub.get_publish_stats('fanout')
+            assert stats['sent'] == 300 and stats['dropped'] == 0, stats
+        finally:
+            slow.close()
+
+    def test_liveness_under_load(self):
+        self.pub.advertise('busy')
+        self.sub.subscribe('busy', lambda msg: None)
+        self.synch('busy')
+        assert self.pub._ctl_clients
+
+        # Keep the data connection busy for longer than a listener would
+        # take to expire
+        payload = 'x' * 100000
+        tstart = time.time()
+        while time.time() - tstart < 2.5 * HB_REPEAT_PERIOD:
+            self.pub.publish('busy', payload)
+            self.pub.spinOnce(0)
+            self.sub.spinOnce(0)
+        assert self.pub.get_listeners('busy') == [self.sub.address]
+
+    def test_timers(self):
+        ticks = []
+        once = []
+        self.pub.create_timer(0.02, lambda: ticks.append(time.time()))
+        self.pub.call_later(0.05, lambda: once.append(time.time()))
+        cancelled = self.pub.call_later(0.01, lambda: once.append(None))
+        self.pub.cancel_timer(cancelled)
+
+        tstart = time.time()
+        while len(ticks) < 5:
+            assert time.time() - tstart < 5, ticks
+            # The timeout is cut short by the next timer
+            self.pub.spinOnce(1)
+
+        assert 0.1 <= ticks[-1] - tstart < 0.5, ticks
+        assert len(once) == 1 and once[0] is not None, once
+        assert once[0] - tstart >= 0.05
+
     def teardown(self):
         self.pub.close()
         self.sub.close()
+
+
+class TestServices(object):
+
+    def setup(self):
+        self.server = DZMQ()
+        self.client = DZMQ()
+
+    def test_call(self):
+        self.server.advertise_service('add', lambda req: req['a'] + req['b'])
+
+        result = {}
+
+        def cb(reply, error):
+            result['reply'] = reply
+
+        self.client.call_async('add', {'a': 1, 'b': 2}, cb, timeout=5)
+        spin_until(lambda: result, [self.client, self.server])
+        assert result['reply'] == 3, result
+
+    def test_many_in_flight(self):
+        self.server.advertise_service('echo', lambda req: req, concurrency=4)
+
+        replies = []
+        for i in range(50):
+            self.client.call_async('echo', i,
+                                   lambda reply, error: replies.append(reply),
+                                   timeout=5)
+        spin_until(lambda: len(replies) >= 50, [self.client, self.server])
+        assert sorted(replies) == list(range(50)), replies
+
+    def test_error(self):
+        def handler(req):
+            raise ValueError('nope')
+
+        self.server.advertise_service('fail', handler)
+
+        result = {}
+
+        def cb(reply, error):
+            result['error'] = error
+
+        self.client.call_async('fail', 'foo', cb, timeout=5)
+        spin_until(lambda: result, [self.client, self.server])
+        assert isinstance(result['error'], ServiceError)
+        assert 'nope' in str(result['error'])
+
+    def test_provider_expiry(self):
+        self.server.advertise_service('echo', lambda req: req)
+
+        result = {}
+
+        def cb(reply, error):
+            result['error'] = error
+
+        self.client.call_async('echo', 'foo', cb)
+        spin_until(lambda: self.client._peer_sockets, [self.client])
+
+        # The provider goes quiet without answering
+        for address in self.client._srv_providers['echo']:
+            self.client._srv_providers['echo'][address] -= SRV_EXPIRE_PERIOD
+        spin_until(lambda: result, [self.client])
+        assert isinstance(result['error'], ServiceError)
+        assert not self.client._peer_sockets
+        assert not self.client._srv_inflight
+
+    def test_timeout(self):
+        try:
+            self.client.call('missing', 'foo', timeout=0.05)
+        except ServiceError:
+            pass
+        else:
+            assert False, 'Expected a ServiceError'
+
+    def teardown(self):
+        self.server.close()
+        self.client.close()
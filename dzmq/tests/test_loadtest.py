@@ -0,0 +1,20 @@
+from dzmq.loadtest import make_plan, run
+
+
+def test_make_plan():
+    plan = make_plan(nodes=4, topics=6, subs=2)
+    assert [len(node['pubs']) for node in plan] == [2, 2, 1, 1]
+    for node in plan:
+        assert len(node['subs']) == 2
+        assert not set(node['subs']) & set(node['pubs'])
+    listeners = sum(sum(node['listeners'].values()) for node in plan)
+    assert listeners == 4 * 2
+
+
+def test_run():
+    results = run(nodes=3, topics=3, subs=1, rate=50, duration=1.0,
+                  connect_timeout=10.0)
+    assert len(results) == 3
+    for result in results:
+        assert result['connected'] is not None, results
+        assert result['received_rate'] > 0, results
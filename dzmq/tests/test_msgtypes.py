@@ -0,0 +1,42 @@
+from dzmq.msgtypes import MessageType, parse_msg_def
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+IMU_DEF = """
+# An IMU sample
+float64 stamp
+float32[3] accel
+uint8 status
+"""
+
+
+def test_parse_msg_def():
+    fields = parse_msg_def(IMU_DEF)
+    assert fields == [('stamp', 'float64', 1), ('accel', 'float32', 3),
+                      ('status', 'uint8', 1)], fields
+
+
+def test_pack_unpack():
+    msg_type = MessageType('Imu', IMU_DEF)
+    msg = {'stamp': 1.5, 'accel': [0.0, 0.5, 9.75], 'status': 3}
+    data = msg_type.pack(msg)
+    assert len(data) == msg_type.size == 8 + 12 + 1
+    assert msg_type.unpack(data) == msg
+
+    if np:
+        record = msg_type.frombuffer(data)
+        assert record['stamp'] == 1.5
+        assert list(record['accel']) == [0.0, 0.5, 9.75]
+
+
+def test_type_hash():
+    first = MessageType('Imu', IMU_DEF)
+    second = MessageType('Imu', [('stamp', 'float64'),
+                                 ('accel', 'float32', 3),
+                                 ('status', 'uint8')])
+    other = MessageType('Imu', [('stamp', 'float32')])
+    assert first.type_hash == second.type_hash
+    assert first.type_hash != other.type_hash
@@ -0,0 +1,40 @@
+from dzmq.topics import TopicTrie, topic_matches
+
+
+def test_topic_matches():
+    assert topic_matches('sensors/imu', 'sensors/imu')
+    assert not topic_matches('sensors/imu', 'sensors/imu2')
+    assert topic_matches('sensors/*', 'sensors/imu')
+    assert not topic_matches('sensors/*', 'sensors/imu/raw')
+    assert topic_matches('sensors/*/raw', 'sensors/imu/raw')
+    assert topic_matches('sensors/', 'sensors/imu/raw', prefix=True)
+    assert not topic_matches('sensors/', 'sensor', prefix=True)
+    assert topic_matches('a.b', 'a.b')
+    assert not topic_matches('a.*', 'abc')
+
+
+def test_trie_match():
+    trie = TopicTrie()
+    trie.insert('sensors/imu', 'exact')
+    trie.insert('sensors/*', 'star')
+    trie.insert('sensors/', 'prefix', prefix=True)
+    trie.insert('*/raw', 'raw')
+    trie.insert('*', 'all')
+
+    assert trie.match('sensors/imu') == ['exact', 'star', 'prefix']
+    assert trie.match('sensors/cam/raw') == ['prefix']
+    assert trie.match('cam/raw') == ['raw']
+    assert trie.match('cam') == ['all']
+    assert trie.match('sensors') == ['all']
+    assert trie.match('other/thing') == []
+
+
+def test_trie_remove():
+    trie = TopicTrie()
+    item = {'cb': None}
+    trie.insert('foo/*', item)
+    trie.insert('foo/bar', 'other')
+    assert trie.match('foo/bar') == [item, 'other']
+
+    trie.remove(item)
+    assert trie.match('foo/bar') == ['other']
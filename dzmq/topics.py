@@ -0,0 +1,185 @@
+import re
+
+
+WILDCARD = '*'
+SEPARATOR = '/'
+CACHE_MAXSIZE = 10000
+
+
+def is_pattern(topic, prefix=False):
+    """
+    Check whether a subscription topic matches more than one topic.
+
+    Parameters
+    ----------
+    topic : str
+        Subscription topic.
+    prefix : bool, optional
+        Whether the topic is to be treated as a prefix.
+
+    Returns
+    -------
+    out : bool
+        True if the topic contains a wildcard or is a prefix.
+    """
+    return prefix or WILDCARD in topic
+
+
+def topic_matches(pattern, topic, prefix=False):
+    """
+    Check whether a topic matches a subscription pattern.
+
+    A `*` in the pattern matches any run of characters other than `/`.  If
+    prefix is set, the pattern need only match the start of the topic.
+
+    Parameters
+    ----------
+    pattern : str
+        Subscription pattern.
+    topic : str
+        Topic name.
+    prefix : bool, optional
+        Whether the pattern is to be treated as a prefix.
+
+    Returns
+    -------
+    out : bool
+        True if the topic matches.
+    """
+    if not is_pattern(pattern, prefix):
+        return pattern == topic
+    regex = '[^%s]*' % SEPARATOR
+    regex = regex.join(re.escape(part) for part in pattern.split(WILDCARD))
+    if not prefix:
+        regex += '$'
+    return re.match(regex, topic) is not None
+
+
+class _Node(object):
+
+    __slots__ = ('children', 'star', 'is_star', 'exact', 'prefix')
+
+    def __init__(self, is_star=False):
+        self.children = {}
+        self.star = None
+        self.is_star = is_star
+        self.exact = []
+        self.prefix = []
+
+
+class TopicTrie(object):
+
+    """
+    Character trie mapping subscription patterns to items, so that all of
+    the items matching a topic can be found in time proportional to the
+    length of the topic.  Resolved matches are cached per topic.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._cache = {}
+        self._count = 0
+
+    def insert(self, pattern, item, prefix=False):
+        """
+        Add an item under a subscription pattern.
+
+        Parameters
+        ----------
+        pattern : str
+            Subscription pattern.
+        item : object
+            Item to return for matching topics.
+        prefix : bool, optional
+            Whether the pattern is to be treated as a prefix.
+        """
+        node = self._root
+        for char in pattern:
+            if char == WILDCARD:
+                if node.star is None:
+                    node.star = _Node(is_star=True)
+                node = node.star
+            else:
+                node = node.children.setdefault(char, _Node())
+        # Keep track of insertion order so that callbacks fire in the
+        # order they were subscribed
+        self._count += 1
+        if prefix:
+            node.prefix.append((self._count, item))
+        else:
+            node.exact.append((self._count, item))
+        self._cache.clear()
+
+    def remove(self, item):
+        """
+        Remove an item from under all patterns.
+
+        Parameters
+        ----------
+        item : object
+            Item to remove.
+        """
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            node.exact = [e for e in node.exact if e[1] is not item]
+            node.prefix = [e for e in node.prefix if e[1] is not item]
+            nodes.extend(node.children.values())
+            if node.star is not None:
+                nodes.append(node.star)
+        self._cache.clear()
+
+    def _closure(self, nodes):
+        """
+        Add the wildcard nodes reachable without consuming a character.
+        """
+        out = []
+        while nodes:
+            node = nodes.pop()
+            if node in out:
+                continue
+            out.append(node)
+            if node.star is not None:
+                nodes.append(node.star)
+        return out
+
+    def match(self, topic):
+        """
+        Find the items whose patterns match a topic.
+
+        Parameters
+        ----------
+        topic : str
+            Topic name.
+
+        Returns
+        -------
+        out : list
+            Matching items, in insertion order.
+        """
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        found = {}
+        nodes = self._closure([self._root])
+        for char in topic:
+            next_nodes = []
+            for node in nodes:
+                found.update(node.prefix)
+                child = node.children.get(char)
+                if child is not None:
+                    next_nodes.append(child)
+                if node.is_star and char != SEPARATOR:
+                    next_nodes.append(node)
+            nodes = self._closure(next_nodes)
+            if not nodes:
+                break
+        for node in nodes:
+            found.update(node.prefix)
+            found.update(node.exact)
+        items = [found[key] for key in sorted(found)]
+        if len(self._cache) >= CACHE_MAXSIZE:
+            self._cache.clear()
+        self._cache[topic] = items
+        return items
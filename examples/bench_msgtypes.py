@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Compare packing and unpacking a fixed shape message through pack_msg and
+unpack_msg with a MessageType.
+
+Usage: bench_msgtypes.py [n_iterations]
+"""
+from __future__ import print_function
+import sys
+import time
+from dzmq import MessageType
+from dzmq.core import pack_msg, unpack_msg
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+imu = MessageType('Imu', """
+float64 stamp
+float64[3] accel
+float64[3] gyro
+uint32 seq
+""")
+
+
+def make_msg(i):
+    return {'stamp': time.time(), 'accel': [0.1, 0.2, 9.8],
+            'gyro': [0.01, 0.02, 0.03], 'seq': i}
+
+
+def bench(name, pack, unpack):
+    msgs = [make_msg(i) for i in range(N)]
+    tstart = time.time()
+    packed = [pack(msg) for msg in msgs]
+    tpack = time.time() - tstart
+    tstart = time.time()
+    [unpack(data) for data in packed]
+    tunpack = time.time() - tstart
+    print('%-12s pack %6.2f us  unpack %6.2f us  size %d bytes' % (
+        name, 1e6 * tpack / N, 1e6 * tunpack / N, len(packed[0])))
+
+
+bench('dict', pack_msg, unpack_msg)
+bench('struct', imu.pack, imu.unpack)
+if imu.dtype is not None:
+    bench('frombuffer', imu.pack, imu.frombuffer)
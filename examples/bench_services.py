@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Measure service call latency and throughput between two nodes.
+
+Usage: bench_services.py [n_calls] [in_flight]
+"""
+from __future__ import print_function
+import sys
+import threading
+import time
+import dzmq
+
+N_CALLS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+IN_FLIGHT = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+done = threading.Event()
+
+
+def serve():
+    server = dzmq.DZMQ()
+    server.advertise_service('bench', lambda req: req)
+    while not done.is_set():
+        server.spinOnce(0.001)
+    server.close()
+
+
+thread = threading.Thread(target=serve)
+thread.start()
+
+client = dzmq.DZMQ()
+# Wait for discovery
+client.call('bench', 0)
+
+# Latency: one call at a time
+latencies = []
+for i in range(N_CALLS):
+    tstart = time.time()
+    client.call('bench', i)
+    latencies.append(time.time() - tstart)
+latencies.sort()
+print('latency: mean %.1f us, p50 %.1f us, p99 %.1f us' % (
+    1e6 * sum(latencies) / len(latencies),
+    1e6 * latencies[len(latencies) // 2],
+    1e6 * latencies[int(len(latencies) * 0.99)]))
+
+# Throughput: keep IN_FLIGHT calls outstanding
+state = {'sent': 0, 'received': 0}
+
+
+def cb(reply, error):
+    state['received'] += 1
+    if state['sent'] < N_CALLS:
+        state['sent'] += 1
+        client.call_async('bench', state['sent'], cb)
+
+
+tstart = time.time()
+for i in range(min(IN_FLIGHT, N_CALLS)):
+    state['sent'] += 1
+    client.call_async('bench', i, cb)
+while state['received'] < N_CALLS:
+    client.spinOnce(0.001)
+print('throughput: %.0f calls/s with %d in flight' % (
+    N_CALLS / (time.time() - tstart), IN_FLIGHT))
+
+done.set()
+thread.join()
+client.close()
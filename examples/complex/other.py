@@ -11,7 +11,8 @@ else:
 
 d.advertise('status')
 d.advertise('log')
-d.advertise('sensor_data')
+# Don't let the sensor loop swamp slow links
+d.advertise('sensor_data', rate=1000, adaptive=True)
 
 
 while not d.get_listeners('log'):
@@ -28,4 +29,5 @@ while i < 10000:
         d.publish('log', 'other says hello')
 
 print(d.get_listeners('log'))
+print(d.get_publish_stats('sensor_data'))
 print('done!')
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 from __future__ import print_function
 import dzmq
-import time
 import sys
 
 if 'linux' in sys.platform:
@@ -29,11 +28,11 @@ def write_log_data(msg):
 d.subscribe('sensor_data', write_sensor_data)
 d.subscribe('log', write_log_data)
 
-tlast = time.time()
-while True:
-    if time.time() - tlast > 1:
-        d.publish('status', 'writer ready')
-        tlast = time.time()
-        print(SENSOR_MSGS, LOG_MSGS)
-    time.sleep(0.001)
-    d.spinOnce(0.001)
+
+def report():
+    d.publish('status', 'writer ready')
+    print(SENSOR_MSGS, LOG_MSGS)
+
+
+d.create_timer(1, report)
+d.spin()
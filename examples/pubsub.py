@@ -2,7 +2,6 @@
 
 import sys
 import dzmq
-import time
 
 if len(sys.argv) > 1:
     topic = sys.argv[1]
@@ -17,13 +16,18 @@ else:
 def cb(msg):
     print('Got %s' % msg)
 
+
 d = dzmq.DZMQ()
 d.subscribe(topic, cb)
 d.advertise(topic)
 
-i = 0
-while True:
-    d.publish(topic, '%s %d' % (msg, i))
-    d.spinOnce(0)
-    time.sleep(0.2)
-    i += 1
+count = [0]
+
+
+def publish():
+    d.publish(topic, '%s %d' % (msg, count[0]))
+    count[0] += 1
+
+
+d.create_timer(0.2, publish)
+d.spin()
@@ -11,6 +11,9 @@ config = {
     'version': '0.1',
     'install_requires': ['pyzmq', 'netifaces'],
     'packages': ['dzmq'],
+    'entry_points': {
+        'console_scripts': ['dzmq-loadtest = dzmq.loadtest:main'],
+    },
     'name': 'disc_zmq'
 }
 